@@ -0,0 +1,86 @@
+import json
+import os
+import tempfile
+
+
+def load_json(path, default=None):
+    try:
+        with open(path) as cache_file:
+            return json.load(cache_file)
+    except (IOError, ValueError):
+        return default
+
+
+def write_atomic(path, data, mode=None):
+    # write to a temporary file and rename, so concurrent readers never
+    # see a partially written file
+    directory = os.path.dirname(os.path.abspath(path))
+    try:
+        os.makedirs(directory)
+    except OSError:
+        pass
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    with os.fdopen(fd, 'w') as output:
+        output.write(data)
+    if mode is not None:
+        # mkstemp creates the file readable by its owner only
+        os.chmod(tmp_path, mode)
+    os.rename(tmp_path, path)
+
+
+def save_json(path, data):
+    write_atomic(path, json.dumps(data))
+
+
+# Content addressed store of small values keyed by object hash: one file
+# per key under a two level fan-out, least recently used entries are
+# evicted once the store grows past max_entries
+class ObjectCache(object):
+
+    def __init__(self, directory, max_entries=100000):
+        self.directory = directory
+        self.max_entries = max_entries
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key[2:])
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path) as cache_file:
+                value = cache_file.read()
+        except IOError:
+            return None
+        # bump the mtime, it's the recency eviction looks at
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return value
+
+    def put(self, key, value):
+        write_atomic(self.path(key), value)
+
+    def prune(self):
+        entries = list()
+        for root, dirs, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    entries.append((os.stat(path).st_mtime, path))
+                except OSError:
+                    pass
+        if len(entries) <= self.max_entries:
+            return 0
+        entries.sort()
+        evicted = entries[:len(entries) - self.max_entries]
+        for mtime, path in evicted:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        return len(evicted)
+
+
+def fingerprint_cache(base_dir):
+    return ObjectCache(os.path.join(base_dir, '.cache', 'fingerprints'))
@@ -1,6 +1,12 @@
 import logging
+import logging.handlers
 import inspect
+import multiprocessing.util
+import os
 import pprint
+import Queue
+import re
+import threading
 
 ANSIcolor = "\033[1;%dm"
 endcolor = "\033[0m"
@@ -17,6 +23,9 @@ COLORS = {
 
 SUCCESS = 25
 
+# project the current thread is working on, see set_project
+context = threading.local()
+
 
 class ColorFormatter(logging.Formatter):
 
@@ -45,12 +54,132 @@ class ColorLogger(logging.Logger):
 
 
     def debugvar(self, var, *args, **kwargs):
-        frame = inspect.currentframe()
-        stack = inspect.getouterframes(frame)
-        prevframe = stack[1][0]
-        msg = pprint.pformat(prevframe.f_locals[var])
-        self.debug('Variable: %s' % var)
-        self.debug(msg, *args, **kwargs)
+        # frame inspection and pformat are skipped entirely when DEBUG is
+        # disabled, and deferred to the handler otherwise
+        if not self.isEnabledFor(logging.DEBUG):
+            return
+        prevframe = inspect.currentframe().f_back
+        self.debug('Variable: %s', var)
+        self.debug('%s', LazyPformat(prevframe.f_locals[var]))
+
+
+class LazyPformat(object):
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return pprint.pformat(self.value)
+
+
+class ProjectFilter(logging.Filter):
+
+    def filter(self, record):
+        record.project = getattr(context, 'project', None)
+        return True
+
+
+class QueueHandler(logging.Handler):
+    # hands records over to the listener thread, the caller only pays for
+    # the enqueue
+
+    def __init__(self, queue):
+        super(QueueHandler, self).__init__()
+        self.queue = queue
+        self.addFilter(ProjectFilter())
+
+    def emit(self, record):
+        # formatted here, like the stdlib QueueHandler.prepare: the args can
+        # change before the listener gets to them, and tracebacks can't
+        # wait. Records of disabled levels never get here
+        message = self.format(record)
+        record.msg = message
+        record.message = message
+        record.args = None
+        record.exc_info = None
+        record.exc_text = None
+        self.queue.put_nowait(record)
+
+
+class LogListener(threading.Thread):
+    # writes every record to the rotated log file of its project, only
+    # summary records reach the console
+
+    def __init__(self, queue, log_dir, console, max_bytes=10485760, backup_count=5):
+        super(LogListener, self).__init__(name='log-listener')
+        self.daemon = True
+        self.queue = queue
+        self.log_dir = log_dir
+        self.console = console
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.files = dict()
+        self.formatter = logging.Formatter('%(asctime)s %(process)d %(threadName)s %(levelname)s %(message)s')
+
+    def project_file(self, project):
+        name = re.sub('[^A-Za-z0-9._-]', '_', project or 'sf-repo')
+        if name not in self.files:
+            handler = logging.handlers.RotatingFileHandler(os.path.join(self.log_dir, '%s.log' % name), maxBytes=self.max_bytes, backupCount=self.backup_count)
+            handler.setFormatter(self.formatter)
+            self.files[name] = handler
+        return self.files[name]
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            self.project_file(record.project).handle(record)
+            if record.name == 'logsummary':
+                self.console.handle(record)
+        for handler in self.files.values():
+            handler.close()
+
+
+def set_project(project_name):
+    context.project = project_name
+
+
+def setup_logging(log_dir=None, level=logging.DEBUG):
+    # Without a log dir everything keeps going synchronously to the console.
+    # Must be called again in forked workers: the listener thread doesn't
+    # survive the fork
+    global listener
+    for logger in (log, logsummary):
+        logger.setLevel(level)
+    if log_dir is None:
+        return
+    try:
+        os.makedirs(log_dir)
+    except OSError:
+        pass
+    queue = Queue.Queue()
+    console = logging.StreamHandler()
+    console.setFormatter(ColorFormatter('%(message)s'))
+    for logger in (log, logsummary):
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+        logger.addHandler(QueueHandler(queue))
+    listener = LogListener(queue, log_dir, console)
+    listener.start()
+    logging_config['log_dir'] = log_dir
+    logging_config['level'] = level
+
+
+def restart_logging():
+    # pool initializer: workers leave through os._exit, the finalizer
+    # drains the queue of the worker before that
+    if logging_config:
+        setup_logging(**logging_config)
+        multiprocessing.util.Finalize(None, stop_logging, exitpriority=10)
+
+
+def stop_logging():
+    global listener
+    if listener is not None:
+        listener.queue.put(None)
+        listener.join()
+        listener = None
 
 
 
@@ -65,6 +194,8 @@ def get_summary_log():
 
 log = get_color_log()
 logsummary = get_summary_log()
+listener = None
+logging_config = dict()
 
 log.info('--- ColorLog Color settings')
 log.info('--- info')
@@ -45,3 +45,12 @@ class ConstrainViolationError(Exception):
     pass
 class CherryPickFailed(Exception):
     pass
+# a git command failed for reasons other than conflicts
+class GitCommandError(Exception):
+    pass
+# a streamed command exited with an error or timed out
+class CommandError(Exception):
+    pass
+# a gerrit query returned an error or was cut short
+class GerritQueryError(Exception):
+    pass
@@ -0,0 +1,209 @@
+import os
+import threading
+from cache import write_atomic
+from colorlog import context as log_context
+
+# seconds, for the duration histograms
+BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600]
+
+HELP = {
+    'sfrepo_command_duration_seconds': 'Duration of the external commands',
+    'sfrepo_command_failures_total': 'External commands that exited with an error or timed out',
+    'sfrepo_project_poll_duration_seconds': 'Duration of a project poll',
+    'sfrepo_project_polls_total': 'Project polls by result',
+    'sfrepo_project_last_poll_duration_seconds': 'Duration of the last poll of the project',
+    'sfrepo_poll_duration_seconds': 'Duration of the last poll of all the projects',
+}
+
+# the branch a thread works on, the project comes from the log context
+context = threading.local()
+
+
+def set_branch(branch):
+    context.branch = branch
+
+
+def labels(**extra):
+    current = {'project': getattr(log_context, 'project', None) or '', 'branch': getattr(context, 'branch', None) or ''}
+    current.update(extra)
+    return current
+
+
+# Counters, gauges and histograms, by metric name and then by sorted label
+# pairs. Pool workers send their dump() back to the parent, which merges it
+class Registry(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = dict()
+        self.gauges = dict()
+        self.histograms = dict()
+
+    def key(self, metric_labels):
+        return tuple(sorted(metric_labels.items()))
+
+    def increment(self, name, value=1, **metric_labels):
+        key = self.key(metric_labels)
+        with self.lock:
+            series = self.counters.setdefault(name, dict())
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **metric_labels):
+        with self.lock:
+            self.gauges.setdefault(name, dict())[self.key(metric_labels)] = value
+
+    def observe(self, name, value, **metric_labels):
+        key = self.key(metric_labels)
+        with self.lock:
+            series = self.histograms.setdefault(name, dict())
+            if key not in series:
+                # one count per bucket, then sum and count
+                series[key] = [0] * len(BUCKETS) + [0.0, 0]
+            histogram = series[key]
+            for index, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    histogram[index] = histogram[index] + 1
+            histogram[-2] = histogram[-2] + value
+            histogram[-1] = histogram[-1] + 1
+
+    def dump(self):
+        with self.lock:
+            return {
+                'counters': dict((name, series.items()) for name, series in self.counters.items()),
+                'gauges': dict((name, series.items()) for name, series in self.gauges.items()),
+                'histograms': dict((name, [(key, list(values)) for key, values in series.items()]) for name, series in self.histograms.items()),
+            }
+
+    def merge(self, data):
+        with self.lock:
+            for name, series in data['counters'].items():
+                counters = self.counters.setdefault(name, dict())
+                for key, value in series:
+                    counters[key] = counters.get(key, 0) + value
+            for name, series in data['gauges'].items():
+                self.gauges.setdefault(name, dict()).update(series)
+            for name, series in data['histograms'].items():
+                histograms = self.histograms.setdefault(name, dict())
+                for key, values in series:
+                    if key in histograms:
+                        histograms[key] = [a + b for a, b in zip(histograms[key], values)]
+                    else:
+                        histograms[key] = list(values)
+
+    def text(self):
+        # prometheus text exposition format
+        lines = list()
+        with self.lock:
+            for metric_type, metrics in [('counter', self.counters), ('gauge', self.gauges)]:
+                for name in sorted(metrics):
+                    lines.append('# HELP %s %s' % (name, HELP.get(name, name)))
+                    lines.append('# TYPE %s %s' % (name, metric_type))
+                    for key, value in sorted(metrics[name].items()):
+                        lines.append('%s%s %s' % (name, format_labels(key), value))
+            for name in sorted(self.histograms):
+                lines.append('# HELP %s %s' % (name, HELP.get(name, name)))
+                lines.append('# TYPE %s histogram' % name)
+                for key, values in sorted(self.histograms[name].items()):
+                    for bound, count in zip(BUCKETS, values):
+                        lines.append('%s_bucket%s %d' % (name, format_labels(key + (('le', repr(float(bound))),)), count))
+                    lines.append('%s_bucket%s %d' % (name, format_labels(key + (('le', '+Inf'),)), values[-1]))
+                    lines.append('%s_sum%s %f' % (name, format_labels(key), values[-2]))
+                    lines.append('%s_count%s %d' % (name, format_labels(key), values[-1]))
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(key):
+    if not key:
+        return ''
+    pairs = ['%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in key]
+    return '{%s}' % ','.join(pairs)
+
+
+registry = Registry()
+metrics_file = None
+
+
+def configure(path):
+    global metrics_file
+    metrics_file = path
+
+
+def use_registry(new_registry):
+    # returns the registry in use until now
+    global registry
+    previous = registry
+    registry = new_registry
+    return previous
+
+
+def increment(name, value=1, **metric_labels):
+    registry.increment(name, value, **metric_labels)
+
+
+def set_gauge(name, value, **metric_labels):
+    registry.set(name, value, **metric_labels)
+
+
+def observe(name, value, **metric_labels):
+    registry.observe(name, value, **metric_labels)
+
+
+def write():
+    # node exporter text file collector style: written aside and renamed
+    if metrics_file is None:
+        return
+    write_atomic(metrics_file, registry.text(), mode=0644)
+
+
+def observe_command(argv, duration, failed):
+    operation, remote = classify(argv)
+    command_labels = labels(operation=operation, remote=remote)
+    observe('sfrepo_command_duration_seconds', duration, **command_labels)
+    if failed:
+        increment('sfrepo_command_failures_total', **command_labels)
+
+
+def observe_poll(project_name, duration, error):
+    observe('sfrepo_project_poll_duration_seconds', duration, project=project_name)
+    set_gauge('sfrepo_project_last_poll_duration_seconds', duration, project=project_name)
+    increment('sfrepo_project_polls_total', project=project_name, result='failed' if error is not None else 'done')
+
+
+GIT_OPERATIONS = {
+    'fetch': 'fetch',
+    'ls-remote': 'fetch',
+    'push': 'push',
+    'cherry-pick': 'cherry-pick',
+    'merge-tree': 'cherry-pick',
+    'commit-tree': 'cherry-pick',
+}
+# git commands whose first argument after the options is a remote
+GIT_REMOTE_COMMANDS = ['fetch', 'ls-remote', 'push']
+
+
+def classify(argv):
+    # (operation, remote) of a command line: git subcommands, gerrit ssh
+    # commands (the last two arguments are host and remote command) and
+    # scp are told apart, anything else goes by program name
+    program = os.path.basename(argv[0])
+    if program == 'git':
+        arguments = list(argv[1:])
+        while arguments and arguments[0].startswith('-'):
+            if arguments[0] in ('-c', '-C'):
+                arguments.pop(0)
+            arguments.pop(0)
+        if not arguments:
+            return 'git', ''
+        subcommand = arguments.pop(0)
+        remote = ''
+        if subcommand in GIT_REMOTE_COMMANDS:
+            positional = [argument for argument in arguments if not argument.startswith('-')]
+            if positional:
+                remote = positional[0]
+        return GIT_OPERATIONS.get(subcommand, 'git-%s' % subcommand), remote
+    if len(argv) >= 2 and argv[-1].startswith('gerrit '):
+        words = argv[-1].split()
+        return 'gerrit-%s' % words[1] if len(words) > 1 else 'gerrit', argv[-2]
+    if program == 'scp':
+        return 'scp', argv[-2].split(':')[0]
+    return program, ''
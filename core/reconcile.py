@@ -0,0 +1,99 @@
+from colorlog import log
+from repotypes.equivalence import patch_ids
+
+
+# Outcome of comparing the upstream changes of a branch with the chain of
+# backports on the replica. Each entry pairs an upstream change with its
+# port in the chain, if any:
+#   change: the upstream change, with its backport prepared
+#   port: the equivalent commit in the chain, or None
+#   port-index: position of the port among the backports, -1 if none
+#   index-differs: the port is not where the change is upstream
+#   contents-differ: the port message or diff is not the upstream one
+# The chain can be kept up to first_divergence, the first entry that is
+# missing, out of order or changed; from there on everything is picked
+# again on top of base_ref, forwardports (replica only commits) last.
+class ReconciliationPlan(object):
+
+    def __init__(self, base_ref):
+        self.base_ref = base_ref
+        self.entries = list()
+        # upstream pick revision -> port
+        self.mapping = dict()
+        self.forwardports = list()
+        self.first_divergence = None
+
+    def order_differences(self):
+        return [entry for entry in self.entries if entry['port'] and entry['index-differs']]
+
+    def content_differences(self):
+        return [entry for entry in self.entries if entry['port'] and entry['contents-differ']]
+
+    def missing(self):
+        return [entry for entry in self.entries if not entry['port']]
+
+    def needs_upload(self):
+        return self.first_divergence is not None
+
+    def to_pick(self):
+        if self.first_divergence is None:
+            return list()
+        return self.entries[self.first_divergence:]
+
+    def summary(self):
+        return "%d upstream changes: %d missing, %d out of order, %d changed, %d forwardports, first divergence at %s" % (len(self.entries), len(self.missing()), len(self.order_differences()), len(self.content_differences()), len(self.forwardports), self.first_divergence)
+
+
+def reconcile(localrepo, changes, backports, chain_revision, base_ref, base=None):
+    # changes: upstream changes in order, with backports prepared
+    # backports: chain revisions above the wedgeports, bottom first
+    # base_ref: where the chain starts, what it is rebuilt on
+    # base: start of the chain history for the equivalence index
+    plan = ReconciliationPlan(base_ref)
+    index = localrepo.equivalence_index(chain_revision, base=base)
+    positions = dict((revision, position) for position, revision in enumerate(backports))
+    picks = [change.backport.pick_revision for change in changes]
+    # patch-ids both find ports and tell whether their content changed
+    pick_patch_ids = patch_ids(localrepo, picks)
+    ported = set()
+
+    for position, change in enumerate(changes):
+        pick = change.backport.pick_revision
+        entry = {'change': change, 'port': None, 'port-index': -1, 'index-differs': True, 'contents-differ': True}
+        port = index.match(pick, patch_id=pick_patch_ids.get(pick))
+        if port is not None and port not in positions:
+            log.warning("Commit %s from upstream matches %s, which is not one of the backports" % (pick, port))
+            port = None
+        if port is not None and port not in ported:
+            entry['port'] = port
+            entry['port-index'] = positions[port]
+            entry['index-differs'] = positions[port] != position
+            entry['contents-differ'] = contents_differ(localrepo, index, port, pick, pick_patch_ids.get(pick))
+            plan.mapping[pick] = port
+            ported.add(port)
+            log.info("Commit %s from upstream was already cherry-picked as %s%s%s" % (pick, port, " in a different position" if entry['index-differs'] else "", " with different content" if entry['contents-differ'] else ""))
+        else:
+            log.info("Commit %s from upstream is not present in the chain" % pick)
+        if plan.first_divergence is None and (entry['port'] is None or entry['index-differs'] or entry['contents-differ']):
+            plan.first_divergence = position
+        plan.entries.append(entry)
+
+    # without divergence the ports are the first backports, in order,
+    # and the forwardports are already on top of them
+    plan.forwardports = [revision for revision in backports if revision not in ported]
+    if plan.first_divergence:
+        plan.base_ref = plan.entries[plan.first_divergence - 1]['port']
+    log.info(plan.summary())
+    return plan
+
+
+def contents_differ(localrepo, index, port, pick, pick_patch_id):
+    # same message and same patch-id, no diff is generated for that
+    port_lines = [line for line in localrepo.objects.commit(port)['body'].split('\n') if line]
+    pick_lines = [line for line in localrepo.objects.commit(pick)['body'].split('\n') if line]
+    if port_lines != pick_lines:
+        return True
+    port_patch_id = index.commit_patch_ids.get(port)
+    if port_patch_id is None or pick_patch_id is None:
+        return localrepo.commits_differ(port, pick)
+    return port_patch_id != pick_patch_id
@@ -1,17 +1,36 @@
 import copy
-import traceback
-from colorlog import log, logsummary
-import sys
-import pprint
-from repotypes.git import LocalRepo
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+from multiprocessing.pool import ThreadPool
+from colorlog import log, logsummary, restart_logging, set_project
+from repotypes.git import Git, LocalRepo
+from repotypes.gerrit import Gerrit
+from repotypes.shellcommand import run
+from repotypes.objectstore import SharedObjectStore
+from cache import fingerprint_cache
+from reconcile import reconcile
+from state import state_store, DONE_RESULTS
 from exceptions import *
+import metrics
+import trace
+
+# seconds between maintenance runs of the caches and the shared store in
+# the long running pollers
+MAINTENANCE_INTERVAL = 3600
 
 class Repos(object):
 
-    def __init__(self, projects_conf, base_dir, filter_projects=None, filter_method=None, filter_branches=None, fetch=True):
+    def __init__(self, projects_conf, base_dir, filter_projects=None, filter_method=None, filter_branches=None, fetch=True, shared_objects=False):
         self.projects = dict()
         self.projects_conf = projects_conf
         self.base_dir = base_dir
+        # bare repository the project repositories borrow objects from
+        self.object_store_dir = None
+        if shared_objects:
+            self.object_store_dir = os.path.join(base_dir, '.objects.git')
         # restrict project to operate on
         projects = copy.deepcopy(projects_conf['projects'])
         project_list = list(projects)
@@ -47,40 +66,238 @@ class Repos(object):
 
         logsummary.info("initializing and updating local repositories for relevant projects")
         self.projects = projects
+        self.last_maintenance = 0
+
+    @trace.traced('Repos.poll')
+    def poll(self, fetch=True, jobs=1):
+        start = time.time()
+        project_names = list(self.projects)
+        snapshots = dict()
+        state = state_store(self.base_dir)
+        if fetch:
+            # without fetch there is nothing new to compare
+            project_names, snapshots = self.precheck(state, project_names, jobs=jobs)
+        polls = [(project_name, self.projects[project_name], self.base_dir + "/" + project_name, fetch, self.object_store_dir) for project_name in project_names]
+        durations = dict()
+        if jobs > 1:
+            log.info("Polling %d projects with %d parallel jobs" % (len(polls), jobs))
+            pool = multiprocessing.Pool(jobs, initializer=restart_logging)
+            try:
+                results = pool.imap_unordered(poll_project, polls)
+                for result in results:
+                    self.poll_finished(state, result, snapshots, durations)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for poll_args in polls:
+                result = poll_project(poll_args)
+                self.poll_finished(state, result, snapshots, durations)
+        state.close()
+        metrics.set_gauge('sfrepo_poll_duration_seconds', time.time() - start)
+        self.log_durations(durations, time.time() - start)
+        self.maintain(min_interval=0)
+        metrics.write()
+
+    def maintain(self, min_interval=MAINTENANCE_INTERVAL):
+        # fingerprint cache eviction and shared store gc, after polls
+        if time.time() - self.last_maintenance < min_interval:
+            return
+        self.last_maintenance = time.time()
+        evicted = fingerprint_cache(self.base_dir).prune()
+        if evicted:
+            log.info("Evicted %d commit fingerprints from cache" % evicted)
+        if self.object_store_dir is not None:
+            SharedObjectStore(self.object_store_dir).maintain()
+
+    def ref_snapshot(self, project_name):
+        # Digest of what a poll of the project depends on: with one
+        # ls-remote per remote, the watched branches and tags on the
+        # original, replica branches and tags on the replica; the open
+        # changes of the replica branches, from the incremental query of
+        # the change cache, as abandoning, restoring or publishing a change
+        # moves no ref; and the project configuration. None if something
+        # cannot be checked
+        project_info = self.projects[project_name]
+        branches = [branch['name'] for branch in project_info['original']['watch-branches']]
+        replica_branches = [branch.get('replica-branch', branch['name']) for branch in project_info['original']['watch-branches']]
+        listings = list()
+        for remote_project, remote_branches in [(project_info['original'], branches), (project_info['replica'], replica_branches + branches)]:
+            patterns = ['refs/heads/%s' % branch for branch in sorted(set(remote_branches))] + ['refs/tags/*']
+            cmd = run(['git', 'ls-remote', remote_url(remote_project)] + patterns, show_stdout=False, timeout=Git.network_timeout)
+            if cmd.returncode != 0:
+                return None
+            listings.append('\n'.join(sorted(cmd.output)))
+        open_changes = self.open_changes_state(project_name, replica_branches)
+        if open_changes is None:
+            return None
+        listings.append(open_changes)
+        listings.append(json.dumps(project_info, sort_keys=True, default=str))
+        return hashlib.sha1('\n\n'.join(listings)).hexdigest()
 
-    def poll(self, fetch=True):
-        for project_name in self.projects:
+    def open_changes_state(self, project_name, replica_branches):
+        # number, current patchset, status and last update of the open
+        # changes, through the change cache of the project repository. None
+        # for a project never polled, or if gerrit can't be queried
+        local_dir = os.path.join(self.base_dir, project_name)
+        if not os.path.exists(os.path.join(local_dir, '.git')):
+            return None
+        replica = self.projects[project_name]['replica']
+        repo = Git(local_dir)
+        try:
+            gerrit = Gerrit(repo, 'replica', replica['location'], replica['name'])
+            state = list()
+            for branch in sorted(set(replica_branches)):
+                for change in gerrit.get_cached_changes(branch):
+                    state.append("%s %s %s %s %s" % (branch, change['number'], change['currentPatchSet']['number'], change['status'], change['lastUpdated']))
+        except (CommandError, GerritQueryError), e:
+            log.warning("Project %s: open changes cannot be checked: %s" % (project_name, e))
+            return None
+        finally:
+            repo.objects.close()
+        return '\n'.join(sorted(state))
+
+    def snapshot_changed(self, state, project_name):
+        # (changed, snapshot), projects that cannot be checked count as changed.
+        # Runs in precheck threads, the ls-remote metrics carry the project
+        set_project(project_name)
+        try:
+            snapshot = self.ref_snapshot(project_name)
+        finally:
+            set_project(None)
+        if snapshot is None:
+            return True, None
+        return snapshot != state.ref_snapshot(project_name), snapshot
+
+    def precheck(self, state, project_names, jobs=1):
+        if jobs > 1:
+            pool = ThreadPool(jobs)
             try:
-                logsummary.info('Polling original for new changes. Checking status of all changes.')
-                project = Project(project_name, self.projects[project_name], self.base_dir + "/"+ project_name, fetch=fetch)
-                logsummary.info("Project: %s initialized" % project_name)
-                project.poll_branches()
-            except Exception, e:
-                traceback.print_exc(file=sys.stdout)
-                log.error(e)
-                logsummary.error("Project %s skipped, reason: %s" % (project_name, e))
+                checks = pool.map(lambda project_name: self.snapshot_changed(state, project_name), project_names)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            checks = [self.snapshot_changed(state, project_name) for project_name in project_names]
+        changed = list()
+        snapshots = dict()
+        for project_name, (project_changed, snapshot) in zip(project_names, checks):
+            if project_changed:
+                changed.append(project_name)
+                snapshots[project_name] = snapshot
+            else:
+                logsummary.info("Project %s: remote refs unchanged since last poll, skipped" % project_name)
+        return changed, snapshots
+
+    def poll_finished(self, state, result, snapshots, durations):
+        # the metrics and trace events recorded by the worker are added to
+        # the ones of this process
+        project_name, initialized, error, duration, metrics_data, trace_events = result
+        self.log_poll_result(project_name, initialized, error)
+        metrics.registry.merge(metrics_data)
+        if trace_events is not None:
+            trace.tracer.merge(trace_events)
+        durations[project_name] = duration
+        self.poll_done(state, (project_name, initialized, error), snapshots)
+
+    def poll_done(self, state, result, snapshots):
+        # the snapshot is recorded only after a poll without errors
+        project_name, initialized, error = result
+        if error is None and snapshots.get(project_name) is not None:
+            state.save_ref_snapshot(project_name, snapshots[project_name])
+
+    def log_durations(self, durations, total):
+        slowest = sorted(durations.items(), key=lambda item: item[1], reverse=True)
+        logsummary.info("Polled %d projects in %.1f seconds" % (len(durations), total))
+        for project_name, duration in slowest[:5]:
+            logsummary.info("Project %s polled in %.1f seconds" % (project_name, duration))
+
+    def load_project(self, project_name, fetch=True):
+        return Project(project_name, self.projects[project_name], self.base_dir + "/" + project_name, fetch=fetch, object_store_dir=self.object_store_dir)
+
+    def log_poll_result(self, project_name, initialized, error):
+        logsummary.info('Polling original for new changes. Checking status of all changes.')
+        if initialized:
+            logsummary.info("Project: %s initialized" % project_name)
+        if error is not None:
+            logsummary.error("Project %s skipped, reason: %s" % (project_name, error))
+
+
+def remote_url(remote_project):
+    # the urls Gerrit and RemoteGit give to their remotes
+    if remote_project.get('type', 'gerrit') == 'git':
+        return "git@%s:%s" % (remote_project['location'], remote_project['name'])
+    return "ssh://%s/%s" % (remote_project['location'], remote_project['name'])
+
+
+def poll_project(poll_args):
+    # Runs in a pool worker: everything returned must be picklable,
+    # so errors travel back to the parent as strings, and metrics and
+    # trace events as the dumps of a registry and a tracer holding only
+    # what this poll recorded
+    project_name, project_info, local_dir, fetch, object_store_dir = poll_args
+    initialized = False
+    error = None
+    start = time.time()
+    previous_registry = metrics.use_registry(metrics.Registry())
+    project_tracer = None
+    if trace.tracer is not None:
+        project_tracer = trace.Tracer()
+    previous_tracer = trace.use_tracer(project_tracer)
+    set_project(project_name)
+    project = None
+    try:
+        with trace.span('poll_project'):
+            project = Project(project_name, project_info, local_dir, fetch=fetch, object_store_dir=object_store_dir)
+            initialized = True
+            project.poll_branches()
+    except Exception, e:
+        log.exception(e)
+        error = str(e)
+    finally:
+        if project is not None:
+            project.close()
+        set_project(None)
+    duration = time.time() - start
+    metrics.observe_poll(project_name, duration, error)
+    project_metrics = metrics.use_registry(previous_registry)
+    trace.use_tracer(previous_tracer)
+    trace_events = None
+    if project_tracer is not None:
+        trace_events = project_tracer.dump()
+    return project_name, initialized, error, duration, project_metrics.dump(), trace_events
+
 
 class Project(object):
 
-    def __init__(self, project_name, project_info, local_dir, fetch=True):
+    @trace.traced('Project.__init__')
+    def __init__(self, project_name, project_info, local_dir, fetch=True, object_store_dir=None):
         self.project_name = project_name
         self.commits = dict()
         self.branches = dict()
         self.base_tags = dict()
 
-        log.info('Current project:\n' + pprint.pformat(project_info))
+        log.debugvar('project_info')
         self.original_project = project_info['original']
         self.replica_project = project_info['replica']
         self.rev_deps = None
         if 'rev-deps' in project_info:
             self.rev_deps = project_info['rev-deps']
         self.wedgeports_count = project_info['replica']['wedgeports-count']
+        # branches polled at the same time, each one in its own worktree
+        self.branch_jobs = project_info['replica'].get('branch-jobs', 4)
 
-        self.localrepo = LocalRepo(project_name, local_dir)
+        object_store = None
+        if object_store_dir is not None:
+            object_store = SharedObjectStore(object_store_dir)
+        self.localrepo = LocalRepo(project_name, local_dir, cherrypick_mode=self.replica_project.get('cherry-pick-mode', 'worktree'), object_store=object_store)
 
-        # Set up remotes
-        self.localrepo.set_replica(self.replica_project['location'], self.replica_project['name'], fetch=fetch)
-        self.localrepo.set_original(self.original_project['type'], self.original_project['location'], self.original_project['name'], fetch=fetch)
+        # last poll results, shared by all the projects in base dir
+        self.state = state_store(os.path.dirname(os.path.abspath(local_dir)))
+
+        # Set up remotes, they are fetched once the branches are known
+        self.localrepo.set_replica(self.replica_project['location'], self.replica_project['name'], fetch=False, partial_clone=self.replica_project.get('partial-clone', False))
+        self.localrepo.set_original(self.original_project['type'], self.original_project['location'], self.original_project['name'], fetch=False, partial_clone=self.original_project.get('partial-clone', False))
         self.original_repo = self.localrepo.remotes['original']
         self.replica_repo = self.localrepo.remotes['replica']
 
@@ -89,142 +306,200 @@ class Project(object):
         # self.original_branches = self.underlayer.list_branches('original')
 
         for branch in project_info['original']['watch-branches']:
+            # a copy, the configuration is part of the ref snapshot digest
+            branch = dict(branch)
             self.branches[branch['name']] = branch
             if 'replica-branch' not in branch:
                 self.branches[branch['name']]['replica-branch'] = branch['name']
+
+        if fetch:
+            self.fetch()
+        else:
+            self.set_base_tags()
+
+    def close(self):
+        # stops the cat-file processes of the project repository
+        self.localrepo.objects.close()
+
+    def set_base_tags(self):
+        # the latest tag can change with every fetch
+        for branch in self.branches.values():
             if 'base-tag' in branch:
                 self.base_tags[branch['name']] = branch['base-tag']
             else:
                 self.base_tags[branch['name']] = self.localrepo.find_latest_tag("replica/" + branch['name'])
 
+    @trace.traced('Project.fetch')
+    def fetch(self):
+        # only what the polls look at: the watched branches with their tags,
+        # and the current patchsets of the open changes on the replica
+        replica_branches = [branch['replica-branch'] for branch in self.branches.values()]
+        self.localrepo.fetch('replica', branches=replica_branches + list(self.branches), shallow_exclude=self.shallow_exclude(self.replica_project))
+        self.localrepo.fetch_changes('replica', refs=self.replica_repo.open_change_refs(replica_branches))
+        self.localrepo.fetch('original', branches=list(self.branches), shallow_exclude=self.shallow_exclude(self.original_project))
+        self.set_base_tags()
 
+    def shallow_exclude(self, remote_project):
+        # with shallow: true the history of a new repository starts at the
+        # base tags, it needs one configured for every branch
+        if not remote_project.get('shallow', False):
+            return None
+        missing = [branch_name for branch_name, branch in self.branches.items() if 'base-tag' not in branch]
+        if missing:
+            log.warning("Project %s: no base-tag for branches %s, fetching full history" % (self.project_name, ', '.join(missing)))
+            return None
+        return sorted(set(branch['base-tag'] for branch in self.branches.values()))
 
-
+    @trace.traced('Project.poll_branches')
     def poll_branches(self):
-        for branch in self.branches:
+        # review operations on the replica are sent together at the end
+        self.replica_repo.begin_batch()
+        try:
+            jobs = min(self.branch_jobs, len(self.branches))
+            if jobs > 1:
+                pool = ThreadPool(jobs)
+                try:
+                    errors = pool.map(self.poll_branch_thread, self.branches)
+                finally:
+                    pool.close()
+                    pool.join()
+                errors = [error for error in errors if error is not None]
+                if errors:
+                    raise errors[0]
+            else:
+                for branch in self.branches:
+                    self.poll_branch(branch)
+        finally:
+            metrics.set_branch(None)
+            self.flush_reviews()
+        self.localrepo.prune_worktrees([branch['replica-branch'] for branch in self.branches.values()])
+
+    def poll_branch_thread(self, branch):
+        # the log context is per thread. Errors are returned, so one branch
+        # failing does not stop the others
+        set_project(self.project_name)
+        try:
             self.poll_branch(branch)
+        except Exception, e:
+            log.exception(e)
+            return e
+        finally:
+            set_project(None)
+            metrics.set_branch(None)
+        return None
+
+    def flush_reviews(self):
+        results = self.replica_repo.flush_batch()
+        failed = ["%s,%s" % change for change, outcome in results.items() if not outcome]
+        if failed:
+            logsummary.warning("Project %s: review failed on changes %s" % (self.project_name, ' '.join(failed)))
 
+    @trace.traced('Project.poll_branch')
     def poll_branch(self, branch):
+        metrics.set_branch(branch)
         replica_branch = self.branches[branch]['replica-branch']
         original_branch = 'remotes/original/' + branch
-        commits_fromtag = self.localrepo.get_commits(self.base_tags[branch], original_branch)
-        if not commits_fromtag:
-            log.info("No new commits in branch")
-            return None
+        base_tag = self.base_tags[branch]
+        original_tip = self.localrepo.get_revision(original_branch)
 
         blocked_changes = self.localrepo.replica_remote.get_blocked_changes()
         if blocked_changes:
             log.info("there are blocked changes that must be solved before continuing")
             return False
 
-        base_ref = self.base_tags[branch]
-        base_branch_name = replica_branch + "/" + base_ref
-        base_branch = self.localrepo.create_branch(base_branch_name, base_ref)
-        original_changes = self.original_repo.local_track.get_changes([commit['hash'] for commit in commits_fromtag], branch=original_branch)
-        # TODO: backport analysis
-        # how many backports, how many commits ? in whic order ?
-        # how many already exist ?
-        # compare_changes list with backports list
-        # what should be merged, what should be skipped ?
-        # how do we advance local repo ?
-        # Analize backports to do, do them all at once,
-        # stop at first troublesome cherrypick, but merge the rest
-        # put all local-only backports on top
-        # XXX: USE OLD MERGE TO COMMIT METHOD
+        # replica changes chain: wedgeports at the bottom, then the backports
+        base_ref = base_tag
         ports = self.replica_repo.get_changes(branch=replica_branch, chain=True, results_key='revision')
-        ports_list = list(backports)
+        ports_list = list(ports)
         wedgeports = ports_list[:self.wedgeports_count]
         if wedgeports:
             base_ref = wedgeports[-1]
         backports = ports_list[self.wedgeports_count:]
-        forwardports = set(backports)
-        if ports:
-            tb_id, top_port = ports.popitem(last=True)
-            chain_ref = top_port.change_branch
+        if ports_list:
+            chain_ref = ports[ports_list[-1]].change_branch
         else:
-            chain_ref = self.base_tags[branch]
+            chain_ref = base_tag
         chain_revision = self.localrepo.get_revision(chain_ref)
-        upload_triggered = False
-        self.scan_ports(original_changes, wedgeports_count, chain_revision)
 
-    def scan_ports(self, original_changews):
-        # TODO: preventive backport, protected backports
-        l = []
-        for index, item in enumerate(original_changes.iteritems()):
-            uuid, change = item
-            e = {}
-            change.prepare_backport(self.replica_repo, replica_branch)
-            e['change'] = change
-            port = self.localrepo.find_equivalent_commit(change.backport.pick_revision, chain_revision)
-            e['port'] = port
-            e['contents-differ'] = True
-            e['port-index'] = -1
-            e['index-differs'] = True
-            if port:
-                log.info("Commit %s from upstream was already cherry-picked as %s in %s branch" % (change.backport.pick_revision, equivalent_backport, branch))
-
-                e['contents-differ'] = self.localrepo.commits_differ(port, change.backport.pick_revision)
-                if e['contents-differ']:
-                    log.info('backported commit content has changed')
-                else:
-                    e['contents-differ'] = False
-                    log.info('backported commit is the same')
-
-                e['port-index'] = backports_list.index(port)
-                if e['port-index'] == index:
-                    log.info('backported commit is in the right order')
-                else:
-                    e['index-differs'] = False
-                    log.info('backported commit is in different order')
-
-                forwardports.remove(port)
-            else:
-                log.info("Commit %s from upstream is not present in %s branch" % (change.backport.pick_revision, branch))
+        # If the chain is the one the last poll left, nothing to do when the
+        # original did not move either, and only the original commits after
+        # the last processed one to look at when it went forward
+        start = base_tag
+        matched = 0
+        state = self.state.branch_state(self.project_name, branch)
+        if state is not None and state['base_tag'] == base_tag and state['replica_tip'] == chain_revision and state['result'] in DONE_RESULTS:
+            if state['original_tip'] == original_tip:
+                log.info("Branch %s: original and replica unchanged since last poll" % branch)
+                return None
+            if state['matched'] <= len(backports) and self.localrepo.is_ancestor(state['original_tip'], original_tip):
+                log.info("Branch %s: scanning original commits after %s" % (branch, state['original_tip']))
+                start = state['original_tip']
+                matched = state['matched']
 
-            l.append(e)
+        commits_fromtag = self.localrepo.get_commits(start, original_branch)
+        if not commits_fromtag:
+            log.info("No new commits in branch")
+            self.state.save_branch_state(self.project_name, branch, base_tag, original_tip, chain_revision, matched, 'up-to-date')
+            return None
 
-        for fp_index, commit in enumerate(forwardports):
-            e = {}
-            change = self.original_repo.find_equivalent_change(commit)
+        # left by older versions, refs/heads/X/Y keeps refs/heads/X from
+        # being created
+        if self.localrepo.objects.resolve('refs/heads/%s/%s' % (replica_branch, base_tag)):
+            self.localrepo.delete_branch('%s/%s' % (replica_branch, base_tag))
+        if matched:
+            base_ref = backports[matched - 1]
+        original_changes = self.original_repo.local_track.get_changes([commit['hash'] for commit in commits_fromtag], branch=original_branch)
+        plan = self.scan_ports(branch, original_changes.values(), backports[matched:], chain_revision, base_ref)
+        # whether up to date or rebuilt, the chain now starts with the
+        # whole upstream range
+        matched = matched + len(plan.entries)
+        if not plan.needs_upload():
+            log.info("Backports in %s are up to date" % replica_branch)
+            self.state.save_branch_state(self.project_name, branch, base_tag, original_tip, chain_revision, matched, 'up-to-date')
+            return None
+        try:
+            latest_commit = self.rebuild_chain(replica_branch, plan)
+        except Exception:
+            self.state.save_branch_state(self.project_name, branch, base_tag, original_tip, chain_revision, 0, 'failed')
+            raise
+        self.state.save_branch_state(self.project_name, branch, base_tag, original_tip, latest_commit, matched, 'uploaded')
+        return True
+
+    @trace.traced('Project.scan_ports')
+    def scan_ports(self, branch, original_changes, backports, chain_revision, base_ref):
+        # TODO: preventive backport, protected backports
+        replica_branch = self.branches[branch]['replica-branch']
+        for change in original_changes:
             change.prepare_backport(self.replica_repo, replica_branch)
-            e['change'] = change
-            e['contents-differ'] = self.localrepo.commits_differ(equivalent_change.revision, commit)
-            e['port-index'] = index + fp_index
-            e['index-differs'] = False
-            l.append(e)
-
-        for index, e in l:
-            if e['port']:
-                # commit already backported
-                # if backport_index != index or differ:
-                # different content is actually very difficult to control
-                # maybe it's better to remove diffcontrol lines from the content
-                if e['index-differs'] or e['contents-differ']:
-                    reupload_chain = True
-                    break
-                else:
-                    base_ref = e['port']
-            else:
-                reupload_chain = True
-                break
+        return reconcile(self.localrepo, original_changes, backports, chain_revision, base_ref, base=self.base_tags[branch])
 
-        if reupload_chain:
-            self.localrepo.create_branch(replica_branch, base_ref)
+    @trace.traced('Project.rebuild_chain')
+    def rebuild_chain(self, replica_branch, plan):
+        # the chain is kept up to the first divergence, from there on
+        # upstream changes are picked again, replica only commits on top
+        self.localrepo.create_branch(replica_branch, plan.base_ref)
 
-            for e in l[index:]:
-                change = e['change']
-                try:
-                    change.backport.auto_attempt(replica_branch)
-                except CherryPickFailed, e:
-                    log.critical("cherry pick failed")
-                    change.backport.request_human_resolution(e)
-                    failure_branch = "failed_attempts/%s" % target_branch
-                    raise
-
-            latest_commit = self.localrepo.get_revision(replica_branch)
-            topic = "update-to-commit-%s" % latest_commit
+        for entry in plan.to_pick():
+            change = entry['change']
             try:
-                self.replica_repo.upload_change(replica_branch, replica_branch, topic)
-            except UploadError:
-                log.crit("upload failed")
+                change.backport.auto_attempt(replica_branch)
+            except CherryPickFailed, e:
+                log.critical("cherry pick failed")
+                change.backport.request_human_resolution(e)
                 raise
+
+        for revision in plan.forwardports:
+            try:
+                self.localrepo.cherrypick(replica_branch, revision)
+            except CherryPickFailed:
+                log.critical("cherry pick of replica commit %s failed" % revision)
+                raise
+
+        latest_commit = self.localrepo.get_revision(replica_branch)
+        topic = "update-to-commit-%s" % latest_commit
+        try:
+            self.replica_repo.upload_change(replica_branch, replica_branch, topic)
+        except UploadError:
+            log.critical("upload failed")
+            raise
+        return latest_commit
@@ -0,0 +1,101 @@
+import os
+import subprocess
+import threading
+from ..colorlog import log
+
+
+# Long running git cat-file --batch/--batch-check processes for a repository:
+# commits and refs are looked up over the same pipes instead of spawning
+# a new git command per object
+class ObjectReader(object):
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.processes = dict()
+        self.refs = dict()
+        # branches are polled in threads, one request at a time on the pipes
+        self.lock = threading.RLock()
+
+    def process(self, mode):
+        process = self.processes.get(mode)
+        if process is None or process.poll() is not None:
+            log.debug("starting git cat-file %s in %s" % (mode, self.directory))
+            with open(os.devnull, 'w') as devnull:
+                process = subprocess.Popen(['git', 'cat-file', mode], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=devnull, cwd=self.directory)
+            self.processes[mode] = process
+        return process
+
+    def request(self, mode, name):
+        with self.lock:
+            process = self.process(mode)
+            process.stdin.write("%s\n" % name)
+            process.stdin.flush()
+            header = process.stdout.readline().rstrip('\n')
+            # "<name> missing" or "<name> ambiguous", the name can contain
+            # spaces so the status is checked before splitting
+            if header.endswith((' missing', ' ambiguous')):
+                return None, None, None
+            object_hash, object_type, size = header.split(' ')
+            data = None
+            if mode == '--batch':
+                data = process.stdout.read(int(size))
+                process.stdout.read(1)
+            return object_hash, object_type, data
+
+    def resolve(self, ref):
+        # works with both tags and branches, tags are peeled to their commit
+        with self.lock:
+            if ref not in self.refs:
+                object_hash, object_type, data = self.request('--batch-check', '%s^{commit}' % ref)
+                if object_hash is None:
+                    return None
+                self.refs[ref] = object_hash
+            return self.refs[ref]
+
+    def invalidate(self):
+        with self.lock:
+            self.refs = dict()
+
+    def commit(self, revision):
+        object_hash, object_type, data = self.request('--batch', '%s^{commit}' % revision)
+        if object_hash is None:
+            return None
+        return parse_commit(object_hash, data)
+
+    def blob(self, name):
+        # name can be anything cat-file understands, like <tree>:<path>
+        object_hash, object_type, data = self.request('--batch', name)
+        return data
+
+    def close(self):
+        with self.lock:
+            for process in self.processes.values():
+                if process.poll() is None:
+                    process.stdin.close()
+                    process.wait()
+            self.processes = dict()
+
+
+def parse_identity(identity):
+    # "Name <email> timestamp tz"
+    ident, timestamp, tz = identity.rsplit(' ', 2)
+    return ident, timestamp, tz
+
+
+def parse_commit(commit_hash, data):
+    headers, _, message = data.partition('\n\n')
+    commit = dict()
+    commit['hash'] = commit_hash
+    commit['parents'] = list()
+    for line in headers.split('\n'):
+        key, _, value = line.partition(' ')
+        if key == 'parent':
+            commit['parents'].append(value)
+        elif key == 'tree':
+            commit['tree'] = value
+        elif key in ('author', 'committer'):
+            commit[key], commit[key + '_date'], commit[key + '_tz'] = parse_identity(value)
+    commit['message'] = message
+    # same as the %b placeholder: message without the subject paragraph
+    commit['body'] = message.partition('\n\n')[2]
+    return commit
@@ -0,0 +1,99 @@
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+# limits of what is reported for a single file, conflicts in generated or
+# vendored files can be huge and the report ends up in a gerrit comment
+MAX_BLOCKS = 20
+MAX_SECTION_LINES = 100
+MAX_LINE_LENGTH = 400
+
+
+def parse_conflicts(lines, max_blocks=MAX_BLOCKS, max_section_lines=MAX_SECTION_LINES):
+    # Reads diff3 style conflict markers from an iterable of lines, once,
+    # keeping only the lines of the blocks:
+    #   <<<<<<< ours label
+    #   ||||||| base label   (only with merge.conflictstyle diff3)
+    #   =======
+    #   >>>>>>> theirs label
+    # Returns the blocks as dicts with 1-based start and end line numbers,
+    # ours/base/theirs line lists and labels, and the count of blocks
+    # found past max_blocks
+    blocks = list()
+    skipped = 0
+    block = None
+    section = None
+    for lineno, line in enumerate(lines, 1):
+        line = line.rstrip('\n')
+        if line.startswith('<<<<<<<'):
+            block = {'start': lineno, 'end': None, 'ours': [], 'base': [], 'theirs': [], 'truncated': False}
+            block['ours_label'] = line[7:].strip()
+            section = 'ours'
+        elif block is None:
+            continue
+        elif line.startswith('|||||||') and section == 'ours':
+            block['base_label'] = line[7:].strip()
+            section = 'base'
+        elif line.startswith('=======') and section in ('ours', 'base'):
+            section = 'theirs'
+        elif line.startswith('>>>>>>>') and section == 'theirs':
+            block['end'] = lineno
+            block['theirs_label'] = line[7:].strip()
+            if len(blocks) < max_blocks:
+                blocks.append(block)
+            else:
+                skipped = skipped + 1
+            block = None
+            section = None
+        elif len(blocks) < max_blocks:
+            if len(block[section]) < max_section_lines:
+                block[section].append(line[:MAX_LINE_LENGTH])
+            else:
+                block['truncated'] = True
+    return blocks, skipped
+
+
+def format_conflicts(blocks, skipped):
+    report = list()
+    for block in blocks:
+        report.append("lines %d-%d:" % (block['start'], block['end']))
+        report.append(("<<<<<<< %s" % block['ours_label']).rstrip())
+        report.extend(block['ours'])
+        if 'base_label' in block:
+            report.append(("||||||| %s" % block['base_label']).rstrip())
+            report.extend(block['base'])
+        report.append("=======")
+        report.extend(block['theirs'])
+        report.append((">>>>>>> %s" % block['theirs_label']).rstrip())
+        if block['truncated']:
+            report.append("(block truncated to %d lines per side)" % MAX_SECTION_LINES)
+    if skipped:
+        report.append("(%d more conflict blocks not shown)" % skipped)
+    return '\n'.join(report)
+
+
+def conflict_report(open_file):
+    conflict_file = open_file()
+    try:
+        blocks, skipped = parse_conflicts(conflict_file)
+    finally:
+        conflict_file.close()
+    if not blocks:
+        return None
+    return format_conflicts(blocks, skipped)
+
+
+def conflict_reports(filenames, open_file, jobs=4):
+    # filename -> text of all its conflict blocks, files without blocks
+    # (deleted on one side, binary) are left out. open_file(filename)
+    # returns a file like object, the files are parsed in parallel
+    filenames = list(filenames)
+    if len(filenames) > 1 and jobs > 1:
+        pool = ThreadPool(min(jobs, len(filenames)))
+        try:
+            reports = pool.map(lambda filename: conflict_report(lambda: open_file(filename)), filenames)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        reports = [conflict_report(lambda: open_file(filename)) for filename in filenames]
+    return OrderedDict((filename, report) for filename, report in zip(filenames, reports) if report is not None)
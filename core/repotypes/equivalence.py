@@ -0,0 +1,117 @@
+import os
+import re
+from shellcommand import pipeline, TEXT
+from ..cache import load_json, save_json, ObjectCache
+from ..colorlog import log
+
+# indexes built with an older layout are built again
+INDEX_VERSION = 2
+# indexes kept per repository, one per chain tip, least recently used are
+# evicted
+MAX_INDEXES = 32
+
+
+def change_id(message):
+    change_ids = re.findall('^Change-Id: (I[0-9a-f]+)\s*$', message, re.MULTILINE)
+    if change_ids:
+        return change_ids[-1]
+    return None
+
+
+def patch_ids(repo, revisions):
+    # revision -> stable patch-id, one git show for all of them
+    if not revisions:
+        return dict()
+    cmd = pipeline([['git', 'show', '--no-color'] + list(revisions), ['git', 'patch-id', '--stable']], show_stdout=False, cwd=repo.directory)
+    revision_patch_ids = dict()
+    for line in cmd.output:
+        patch_id, commit_hash = line.split(' ')
+        revision_patch_ids[commit_hash] = patch_id
+    return revision_patch_ids
+
+
+# Maps patch-id, author identity/date/subject and Change-Id of every commit in a
+# range to the commit itself, so equivalent commits can be found without
+# scanning the branch history for every lookup
+class EquivalenceIndex(object):
+
+    def __init__(self, repo, tip, base=None):
+        self.repo = repo
+        self.tip = tip
+        self.base = base
+        directory = os.path.join(repo.cache_dir, 'equivalence')
+        self.path = os.path.join(directory, '%s.json' % tip)
+        data = load_json(self.path)
+        if data is None or data['base'] != base or data.get('version') != INDEX_VERSION:
+            data = self.build()
+            save_json(self.path, data)
+            ObjectCache(directory, max_entries=MAX_INDEXES).prune()
+        else:
+            # the mtime is the recency eviction looks at
+            try:
+                os.utime(self.path, None)
+            except OSError:
+                pass
+        self.patch_ids = data['patch-ids']
+        self.authors = data['authors']
+        self.change_ids = data['change-ids']
+        self.commit_patch_ids = data['commit-patch-ids']
+
+    def build(self):
+        if self.base:
+            interval = '%s..%s' % (self.base, self.tip)
+        else:
+            interval = self.tip
+        log.info("Building equivalence index for %s" % interval)
+        data = dict()
+        data['version'] = INDEX_VERSION
+        data['base'] = self.base
+        data['patch-ids'] = dict()
+        data['authors'] = dict()
+        data['change-ids'] = dict()
+        data['commit-patch-ids'] = dict()
+
+        cmd = self.repo.git('log', '-z', '--pretty=format:%H%x1f%an <%ae>%x1f%at%x1f%B', interval, output_mode=TEXT, show_stdout=False)
+        for record in cmd.output.split('\0'):
+            if not record.strip('\n'):
+                continue
+            commit_hash, author, date, message = record.strip('\n').split('\x1f', 3)
+            # dates are in seconds: commits sharing author, date and
+            # subject can't be told apart this way, their key maps to None
+            key = self.author_key(author, date, message)
+            if key in data['authors']:
+                data['authors'][key] = None
+            else:
+                data['authors'][key] = commit_hash
+            commit_change_id = change_id(message)
+            if commit_change_id:
+                data['change-ids'].setdefault(commit_change_id, commit_hash)
+
+        cmd = pipeline([['git', 'log', '-p', '--no-color', interval], ['git', 'patch-id', '--stable']], show_stdout=False, cwd=self.repo.directory)
+        for line in cmd.output:
+            patch_id, commit_hash = line.split(' ')
+            data['patch-ids'].setdefault(patch_id, commit_hash)
+            data['commit-patch-ids'][commit_hash] = patch_id
+
+        return data
+
+    def author_key(self, author, date, message):
+        # the subject tells apart commits of the same author in the same second
+        return "%s %s %s" % (author, date, message.strip().split('\n')[0])
+
+    def match(self, revision, patch_id=None):
+        # patch_id of revision, when the caller already has it
+        # Change-Id and patch-id first, author, date and subject only as a
+        # last resort for ports whose diff changed, and only when unambiguous
+        commit = self.repo.objects.commit(revision)
+        commit_change_id = change_id(commit['message'])
+        if commit_change_id in self.change_ids:
+            return self.change_ids[commit_change_id]
+        if patch_id is None:
+            patch_id = patch_ids(self.repo, [revision]).get(commit['hash'])
+        if patch_id in self.patch_ids:
+            return self.patch_ids[patch_id]
+        return self.authors.get(self.author_key(commit['author'], commit['author_date'], commit['message']))
+
+    def lookup(self, revision):
+        return self.match(revision)
@@ -1,60 +1,152 @@
+import copy
 import json
-import pprint
+import os
+import re
+import threading
+import time
+from ..cache import load_json, save_json
 from ..colorlog import log
-from shellcommand import shell
+from ..exceptions import GerritQueryError
+from shellcommand import run, stream
+from sshpool import pool
 from ..datastructures import Change
 from collections import OrderedDict
 
 
 class Gerrit(object):
 
+    # seconds before a gerrit ssh command is killed
+    command_timeout = 300
+    # seconds added to incremental queries to cover clock skew with the server
+    cache_slack = 300
+    # cached changes are reloaded from scratch after this many seconds
+    cache_max_age = 86400
+
     def __init__(self, localrepo, name, host, project_name):
         self.host = host
         self.name = name
         self.project_name = project_name
         self.url = "ssh://%s/%s" % (host, project_name)
         self.localrepo = localrepo
+        self.cache_path = os.path.join(localrepo.cache_dir, 'gerrit-%s.json' % name)
+        self.batch = None
+        # branches polled in threads share the cache file
+        self.cache_lock = threading.Lock()
 
-    def query_changes_json(self, query, comments=False):
-        changes_infos = list()
-        cmd = shell('ssh %s gerrit query --comments --current-patch-set --format json --dependencies --submit-records %s' % (self.host,query))
-        log.debug(pprint.pformat(cmd.output))
-        for change_json in cmd.output:
-            if change_json !='':
-                change = json.loads(change_json)
-                if "type" not in change or (change['type'] != 'stats' and change['type'] != 'error'):
-                    changes_infos.append(change)
+    def ssh(self, command, **kwargs):
+        with pool.session(self.host):
+            return run(pool.command(self.host, command), timeout=self.command_timeout, **kwargs)
 
+    def ssh_stream(self, command):
+        with pool.session(self.host):
+            for line in stream(pool.command(self.host, command), timeout=self.command_timeout, check=True):
+                yield line
+
+    def iter_changes_json(self, query):
+        # Changes are parsed as ssh outputs them. Gerrit stops at its query
+        # limit and flags it in the final stats record, so the query is
+        # repeated with --start until all the results are read. A failed
+        # query raises (CommandError from ssh, GerritQueryError for error
+        # records or a missing stats record): the caller can't tell a
+        # partial result from a complete one
+        start = 0
+        while True:
+            more_changes = False
+            row_count = 0
+            stats = False
+            lines = self.ssh_stream('gerrit query --comments --current-patch-set --format json --dependencies --submit-records --start %d %s' % (start, query))
+            try:
+                for change_json in lines:
+                    if not change_json:
+                        continue
+                    change = json.loads(change_json)
+                    if change.get('type') == 'stats':
+                        stats = True
+                        more_changes = change.get('moreChanges', False)
+                        row_count = change.get('rowCount', 0)
+                    elif change.get('type') == 'error':
+                        log.error("query on %s gerrit failed: %s" % (self.name, change.get('message')))
+                        raise GerritQueryError("query on %s gerrit failed: %s" % (self.name, change.get('message')))
+                    else:
+                        yield change
+            finally:
+                # stops the command and frees the ssh session right away
+                lines.close()
+            if not stats:
+                raise GerritQueryError("query on %s gerrit ended without stats" % self.name)
+            if not more_changes or not row_count:
+                break
+            start = start + row_count
+            log.debug("query on %s gerrit continues from result %d" % (self.name, start))
         log.debug("end query json")
-        return changes_infos
+
+    def query_changes_json(self, query, comments=False):
+        return list(self.iter_changes_json(query))
+
+    def begin_batch(self):
+        # from now on review operations are queued until flush_batch
+        if self.batch is None:
+            self.batch = ReviewBatch(self)
+
+    def flush_batch(self):
+        batch = self.batch
+        self.batch = None
+        if batch is None:
+            return dict()
+        return batch.flush()
+
+    def review(self, number, patchset, options, review_input=None):
+        if self.batch is not None:
+            self.batch.add(number, patchset, options, review_input=review_input)
+            return True
+        return self.review_changes([(number, patchset)], options, review_input=review_input)
+
+    def review_changes(self, changes, options, review_input=None):
+        return not self.review_failures(changes, options, review_input=review_input)
+
+    def review_failures(self, changes, options, review_input=None):
+        # gerrit review takes several change,patchset at once, but a json
+        # review input only for a single one. Returns the changes the review
+        # failed on
+        command = 'gerrit review %s %s' % (options, ' '.join(["%s,%s" % change for change in changes]))
+        if review_input is not None:
+            json_input = json.dumps(review_input, ensure_ascii=False)
+            if isinstance(json_input, unicode):
+                json_input = json_input.encode('utf-8')
+            cmd = self.ssh(command, stdin=json_input)
+        else:
+            cmd = self.ssh(command)
+        if cmd.returncode == 0:
+            return list()
+        return failed_changes(changes, cmd.errors)
 
     def approve_change(self, number, patchset):
-        shell('ssh %s gerrit review --code-review 2 --verified 1 %s,%s' % (self.host, number, patchset))
+        self.review(number, patchset, '--code-review 2 --verified 1')
 
     def reject_change(self, number, patchset):
-        shell('ssh %s gerrit review --code-review -2 --verified -1 %s,%s' % (self.host, number, patchset))
+        self.review(number, patchset, '--code-review -2 --verified -1')
 
     def submit_change(self, number, patchset):
-        shell('ssh %s gerrit review --publish --project %s %s,%s' % (self.host, self.project_name, number, patchset))
-        shell('ssh %s gerrit review --submit --project %s %s,%s' % (self.host, self.project_name, number, patchset))
-        cmd = shell('ssh %s gerrit query --format json "change:%s AND status:merged"' % (self.host, number))
+        self.ssh('gerrit review --publish --project %s %s,%s' % (self.project_name, number, patchset))
+        self.ssh('gerrit review --submit --project %s %s,%s' % (self.project_name, number, patchset))
+        cmd = self.ssh('gerrit query --format json "change:%s AND status:merged"' % (number))
         if cmd.output[:-1]:
             return True
         return False
 
     def publish_change(self, number, patchset):
-        shell('ssh %s gerrit review --publish --project %s %s,%s' % (self.host, self.project_name, number, patchset))
+        self.review(number, patchset, '--publish --project %s' % self.project_name)
 
     def abandon_change(self, number, patchset):
-        shell('ssh %s gerrit review --abandon --project %s %s,%s' % (self.host, self.project_name, number, patchset))
+        self.review(number, patchset, '--abandon --project %s' % self.project_name)
 
     def upload_change(self, source_branch, target_branch, topic, reviewers=None):
-        command = 'git push %s %s:refs/drafts/%s/%s' % (self.name, source_branch, target_branch, topic)
+        refspec = '%s:refs/drafts/%s/%s' % (source_branch, target_branch, topic)
         if reviewers:
-            command = "%s%%" % command
+            refspec = "%s%%" % refspec
             for reviewer in reviewers:
-                command = command + "r=%s," % reviewer
-            command.rstrip(',')
+                refspec = refspec + "r=%s," % reviewer
+            refspec = refspec.rstrip(',')
 
         # FIXME: check upload results in another way
         #cmd = shell('git review -D -r %s -t "%s" %s' % (self.name, topic, branch))
@@ -63,10 +155,11 @@ class Gerrit(object):
         #        log.debug("trying alternative upload method")
         #        shell("git push %s HEAD:refs/drafts/%s/%s" % (self.name, branch, topic))
         #        break
-        shell(command)
-        log.debug(command)
-        cmd = shell('git branch -D %s' % source_branch)
-        cmd = shell('ssh %s gerrit query --current-patch-set --format json "topic:%s AND status:open"' % (self.host, topic))
+        self.localrepo.git('push', self.name, refspec)
+        log.debug(refspec)
+        # the ref cache is invalidated by delete_branch
+        self.localrepo.delete_branch(source_branch)
+        cmd = self.ssh('gerrit query --current-patch-set --format json "topic:%s AND status:open"' % (topic))
         if not cmd.output[:-1]:
             return None
         gerrit_infos = json.loads(cmd.output[:-1][0])
@@ -86,9 +179,7 @@ class Gerrit(object):
         if verified:
             review_input['labels']['Verified'] = verified
 
-        json_input = json.dumps(review_input, ensure_ascii=False)
-
-        cmd = shell("echo '%s' | ssh %s gerrit review --json %s,%s" % (json_input, self.host, number, patchset))
+        self.review(number, patchset, '--json', review_input=review_input)
 
     def get_query_string(self, criteria, ids, branch=None, search_merged=True):
         query_string = '\(%s:%s' % (criteria, ids[0])
@@ -132,10 +223,53 @@ class Gerrit(object):
 
         return gerrit_infos
 
+    def get_cached_changes(self, branch):
+        # Open changes for the branch. After the first load only changes
+        # updated since the last query are asked to gerrit and merged in
+        with self.cache_lock:
+            branch_cache = load_json(self.cache_path, default=dict()).get(branch)
+        query_start = int(time.time())
+        query_string = "project:%s AND branch:%s" % (self.project_name, branch)
+        if branch_cache is None or query_start - branch_cache['loaded'] > self.cache_max_age:
+            branch_cache = {'loaded': query_start, 'watermark': query_start, 'changes': dict()}
+            query_string = query_string + " AND status:open"
+        else:
+            age = query_start - branch_cache['watermark'] + self.cache_slack
+            query_string = query_string + " AND -age:%ds" % age
+            log.debug("incremental query on %s gerrit since %d" % (self.name, branch_cache['watermark']))
+
+        changes = branch_cache['changes']
+        for change in self.iter_changes_json(query_string):
+            number = str(change['number'])
+            if number in changes and changes[number]['lastUpdated'] > change['lastUpdated']:
+                continue
+            if change['status'] in ('NEW', 'DRAFT'):
+                changes[number] = change
+            else:
+                changes.pop(number, None)
+        # only a query that completed moves the watermark, iter_changes_json
+        # raises otherwise
+        branch_cache['watermark'] = query_start
+        with self.cache_lock:
+            # other branches may have been saved in the meantime
+            cache = load_json(self.cache_path, default=dict())
+            cache[branch] = branch_cache
+            save_json(self.cache_path, cache)
+
+        # normalize_infos modifies the data it gets
+        return [copy.deepcopy(change) for change in changes.values()]
+
+    def open_change_refs(self, branches):
+        # refs/changes/NN/N/P of the current patchset of the open changes
+        refs = list()
+        for branch in branches:
+            for change in self.get_cached_changes(branch):
+                refs.append(change['currentPatchSet']['ref'])
+        return refs
+
     def get_changes(self, search_values=None, search_field='change', results_key='id', sort_key='number', branch=None, search_merged=True, single_result=False, raw_data=False, chain=False):
         #query_string = self.get_query_string(search_field, search_values, branch=branch, search_merged=search_merged)
-        query_string = "project:%s AND branch:%s AND status:open" % (self.project_name, branch)
-        changes_data = self.query_changes_json(query_string)
+        changes_data = self.get_cached_changes(branch)
 
         if single_result and len(changes_data) != 1:
             return None
@@ -176,3 +310,60 @@ class Gerrit(object):
             return results_chain
 
         return results
+
+
+def failed_changes(changes, errors):
+    # Gerrit writes an error line for each change a review failed on, as
+    # "error: ..." or "fatal: ...", naming it as number,patchset or as
+    # "change number". When no line names one of the changes, all of them
+    # are taken as failed
+    pairs = set()
+    numbers = set()
+    for line in errors:
+        if not line.startswith(('error:', 'fatal:')):
+            continue
+        pairs.update(re.findall(r'(\d+),(\d+)', line))
+        numbers.update(re.findall(r'change (\d+)\b(?!,)', line))
+    failed = [change for change in changes if (str(change[0]), str(change[1])) in pairs or str(change[0]) in numbers]
+    if not failed:
+        return list(changes)
+    return failed
+
+
+class ReviewBatch(object):
+
+    def __init__(self, remote):
+        self.remote = remote
+        # review options -> changes, in the order they were first queued.
+        # Json review inputs are per change, so each one is a group of its own
+        self.groups = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, number, patchset, options, review_input=None):
+        with self.lock:
+            if review_input is not None:
+                key = (options, len(self.groups))
+            else:
+                key = (options, None)
+            if key not in self.groups:
+                self.groups[key] = {'changes': [], 'review_input': review_input}
+            if (number, patchset) not in self.groups[key]['changes']:
+                self.groups[key]['changes'].append((number, patchset))
+
+    def flush(self):
+        # returns (number, patchset) -> True if all its operations succeeded
+        results = OrderedDict()
+        with self.lock:
+            groups = self.groups
+            self.groups = OrderedDict()
+        for (options, unique), group in groups.items():
+            changes = group['changes']
+            # gerrit goes on with the other changes when one fails, they
+            # are not reviewed again
+            failed = self.remote.review_failures(changes, options, review_input=group['review_input'])
+            outcomes = [(change, change not in failed) for change in changes]
+            for change, outcome in outcomes:
+                results[change] = results.get(change, True) and outcome
+                if not outcome:
+                    log.error("review %s failed on %s gerrit for change %s,%s" % (options, self.remote.name, change[0], change[1]))
+        return results
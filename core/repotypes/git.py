@@ -2,165 +2,387 @@ import hashlib
 import sys
 import os
 import re
-from shellcommand import shell
+import shutil
+import StringIO
+import threading
+from shellcommand import run, stream, TEXT, SINGLE_VALUE
+from catfile import ObjectReader
+from conflicts import conflict_reports
+from equivalence import EquivalenceIndex
 from ..datastructures import Change
 from gerrit import Gerrit
+from sshpool import pool
+from ..cache import fingerprint_cache, load_json, save_json
 from ..colorlog import log, logsummary
-from ..exceptions import CherryPickFailed, RemoteFetchError
+from ..exceptions import CherryPickFailed, GitCommandError, RemoteFetchError
 from collections import OrderedDict
 
+# git status --porcelain codes of unmerged paths
+UNMERGED_STATUS = ['DD', 'AU', 'UD', 'UA', 'DU', 'AA', 'UU']
+# merge-tree --merge-base, needed by the in-memory cherry-pick mode
+IN_MEMORY_GIT_VERSION = (2, 40)
+# git commands talking to remotes, they get network_timeout
+NETWORK_COMMANDS = ['fetch', 'push', 'ls-remote']
+# fetch and push output is only logged: progress and ref updates, capped
+MAX_NETWORK_OUTPUT = 1048576
+
 
 class Git(object):
 
-    def __init__(self, directory):
+    # seconds before a network git command is killed, --git-timeout
+    network_timeout = 600
+
+    def __init__(self, directory, object_store=None):
         self.directory = directory
         self.remotes = dict()
         try:
             os.mkdir(self.directory)
         except OSError:
             pass
-        os.chdir(self.directory)
         try:
-            os.stat(".git")
+            os.stat(os.path.join(self.directory, ".git"))
         except OSError:
-            shell('git init')
+            run(['git', 'init'], cwd=self.directory)
+        self.object_store = object_store
+        if object_store is not None:
+            object_store.link(os.path.join(self.directory, '.git'))
+        self.objects = ObjectReader(self.directory)
+        self.cache_dir = os.path.join(self.directory, '.git', 'sf-repo')
+        # shared by all the projects in base dir
+        self.fingerprints = fingerprint_cache(os.path.dirname(os.path.abspath(self.directory)))
+        self.tag_map = None
+        # remote -> refspecs of its last fetch, deepen repeats them
+        self.fetch_refspecs = dict()
+        self.deepen_step = 64
+        self.latest_tags = load_json(os.path.join(self.cache_dir, 'latest-tags.json'), default=dict())
+
+    def git(self, *args, **kwargs):
+        kwargs.setdefault('cwd', self.directory)
+        if args and args[0] in NETWORK_COMMANDS:
+            kwargs.setdefault('timeout', self.network_timeout)
+            if args[0] != 'ls-remote':
+                kwargs.setdefault('max_output', MAX_NETWORK_OUTPUT)
+        return run(['git'] + list(args), **kwargs)
 
     def get_revision(self, ref):
-        os.chdir(self.directory)
         # works with both tags and branches
-        cmd = shell('git rev-list -n 1 %s' % ref)
-        revision = cmd.output[0].rstrip('\n')
-        return revision
-
-    def addremote(self, repo, fetch=True):
-        os.chdir(self.directory)
-        cmd = shell('git remote | grep ^%s$' % repo.name)
-        if cmd.returncode != 0:
-            shell('git remote add %s %s' % (repo.name, repo.url))
+        return self.objects.resolve(ref)
+
+    def addremote(self, repo, fetch=True, partial_clone=False):
+        if repo.name not in self.git('remote').output:
+            self.git('remote', 'add', repo.name, repo.url)
+        if partial_clone:
+            # commits and trees are fetched, blobs are fetched by git from
+            # the remote the first time something reads them
+            self.git('config', 'remote.%s.promisor' % repo.name, 'true')
+            self.git('config', 'remote.%s.partialclonefilter' % repo.name, 'blob:none')
         if fetch:
-            cmd = shell('git fetch %s' % (repo.name))
-            if cmd.returncode != 0:
-                raise RemoteFetchError
+            self.fetch(repo.name)
         self.remotes[repo.name] = repo
 
-    def fetch_changes(self, name):
-        shell('git fetch %s +refs/changes/*:refs/remotes/%s/changes/*' % (name, name))
+    def store_fetch(self, remote_name, refspecs):
+        # objects go to the shared store first, the fetch in the project
+        # repository then finds them there and transfers nothing
+        if self.object_store is None:
+            return
+        url = self.git('config', 'remote.%s.url' % remote_name, output_mode=SINGLE_VALUE).output
+        namespace = '%s/%s' % (os.path.basename(os.path.abspath(self.directory)), remote_name)
+        if not self.object_store.fetch(url, namespace, refspecs, timeout=self.network_timeout):
+            log.warning("fetch of %s in the shared object store failed" % remote_name)
+
+    def remote_branches(self, remote_name):
+        cmd = self.git('ls-remote', '--heads', remote_name)
+        if cmd.returncode != 0:
+            raise RemoteFetchError
+        return set(line.split('\t', 1)[1][len('refs/heads/'):] for line in cmd.output)
+
+    def fetch(self, remote_name, branches=None, shallow_exclude=None):
+        # Without branches everything is fetched. With branches only those
+        # are, with the tags git follows in their history; branches the
+        # remote does not have are skipped.
+        # shallow_exclude tags limit the history of the first fetch of the
+        # remote: it stops at them, the tagged commits included
+        options = list()
+        if shallow_exclude and not self.list_branches(remote_name):
+            options = ['--shallow-exclude=%s' % ref for ref in shallow_exclude]
+        if branches is None:
+            refspecs = list()
+            self.store_fetch(remote_name, [('refs/heads/*', 'heads/*'), ('refs/tags/*', 'tags/*')])
+        else:
+            advertised = self.remote_branches(remote_name)
+            for branch in sorted(set(branches) - advertised):
+                log.warning("branch %s not found in %s" % (branch, remote_name))
+            wanted = sorted(set(branches) & advertised)
+            if not wanted:
+                return
+            refspecs = ['+refs/heads/%s:refs/remotes/%s/%s' % (branch, remote_name, branch) for branch in wanted]
+            self.store_fetch(remote_name, [('refs/heads/%s' % branch, 'heads/%s' % branch) for branch in wanted])
+        cmd = self.git('fetch', *(options + [remote_name] + refspecs))
+        if options and cmd.returncode == 0:
+            # the tagged commits themselves, without their history
+            cmd = self.git('fetch', '--depth=1', remote_name, *['+refs/tags/%s:refs/tags/%s' % (tag, tag) for tag in shallow_exclude])
+        self.fetch_refspecs[remote_name] = refspecs
+        self.objects.invalidate()
+        self.tag_map = None
+        if cmd.returncode != 0:
+            raise RemoteFetchError
 
-    def add_gerrit_remote(self, localrepo, name, location, project_name, fetch=True, fetch_changes=True):
+    def shallow_commits(self):
+        try:
+            with open(os.path.join(self.directory, '.git', 'shallow')) as shallow_file:
+                return set(shallow_file.read().split())
+        except IOError:
+            return set()
+
+    def deepen(self):
+        # A shallow history was not enough: fetch more of it, twice as much
+        # each time. False when there is nothing more to get
+        shallow = self.shallow_commits()
+        if not shallow:
+            return False
+        log.info("deepening history by %d commits" % self.deepen_step)
+        remotes = self.fetch_refspecs or dict((remote_name, []) for remote_name in self.git('remote').output)
+        for remote_name, refspecs in remotes.items():
+            self.git('fetch', '--deepen=%d' % self.deepen_step, remote_name, *refspecs)
+        self.deepen_step = self.deepen_step * 2
+        self.objects.invalidate()
+        self.tag_map = None
+        return self.shallow_commits() != shallow
+
+    def fetch_changes(self, name, refs=None):
+        # Without refs all the change refs are fetched. With refs, a list
+        # of refs/changes/NN/N/P, the missing ones are fetched and the
+        # local copies of all the others are deleted. Patchset refs never
+        # move, one already here is not fetched again
+        if refs is None:
+            self.store_fetch(name, [('refs/changes/*', 'changes/*')])
+            self.git('fetch', name, '+refs/changes/*:refs/remotes/%s/changes/*' % name)
+            self.objects.invalidate()
+            return
+        prefix = 'refs/remotes/%s/' % name
+        local = set(self.git('for-each-ref', '--format=%(refname)', prefix + 'changes/').output)
+        wanted = dict((prefix + ref[len('refs/'):], ref) for ref in refs)
+        missing = sorted(ref for local_ref, ref in wanted.items() if local_ref not in local)
+        stale = sorted(local - set(wanted))
+        log.info("change refs from %s: %d to fetch, %d up to date, %d stale" % (name, len(missing), len(wanted) - len(missing), len(stale)))
+        if missing:
+            self.store_fetch(name, [(ref, ref[len('refs/'):]) for ref in missing])
+            self.git('fetch', '--no-tags', name, *['+%s:%s%s' % (ref, prefix, ref[len('refs/'):]) for ref in missing])
+        if stale:
+            self.git('update-ref', '--stdin', stdin=''.join(["delete %s\n" % ref for ref in stale]))
+        self.objects.invalidate()
+
+    def add_gerrit_remote(self, localrepo, name, location, project_name, fetch=True, fetch_changes=True, partial_clone=False):
         repo = Gerrit(localrepo, name, location, project_name)
-        self.addremote(repo, fetch=fetch)
+        self.addremote(repo, fetch=fetch, partial_clone=partial_clone)
         repo.local_track = TrackedRepo(self, name, self.directory, project_name)
         if fetch_changes:
             self.fetch_changes(name)
         try:
-            os.stat(".git/hooks/commit-msg")
+            os.stat(os.path.join(self.directory, ".git/hooks/commit-msg"))
         except OSError:
-            shell('scp -p %s:hooks/commit-msg .git/hooks/' % location)
+            run(pool.scp_command('%s:hooks/commit-msg' % location, '.git/hooks/'), cwd=self.directory, timeout=self.network_timeout)
 
-    def add_git_remote(self, localrepo, name, location, project_name, fetch=True):
-        repo = RemoteGit(name, location, self.directory, project_name)
-        self.addremote(repo, fetch=fetch)
+    def add_git_remote(self, localrepo, name, location, project_name, fetch=True, partial_clone=False):
+        repo = RemoteGit(localrepo, name, location, self.directory, project_name)
+        self.addremote(repo, fetch=fetch, partial_clone=partial_clone)
 
     def list_branches(self, remote_name, pattern=''):
-        os.chdir(self.directory)
-        cmd = shell('git for-each-ref --format="%%(refname)" refs/remotes/%s/%s | sed -e "s/refs\/remotes\/%s\///"' % (remote_name, pattern, remote_name))
-        return cmd.output
+        prefix = 'refs/remotes/%s/' % remote_name
+        cmd = self.git('for-each-ref', '--format=%(refname)', prefix + pattern)
+        return [ref[len(prefix):] for ref in cmd.output]
 
     def track_branch(self, branch, remote_branch):
-        os.chdir(self.directory)
-        shell('git checkout parking')
-        shell('git branch --track %s %s' % (branch, remote_branch))
+        self.git('branch', '--track', branch, remote_branch)
+        self.objects.invalidate()
 
     def delete_branch(self, branch):
-        os.chdir(self.directory)
-        shell('git checkout parking')
-        shell('git branch -D %s' % branch)
+        self.git('branch', '-D', branch)
+        self.objects.invalidate()
 
     def delete_remote_branches(self, remote_name, branches):
-        os.chdir(self.directory)
         for branch in branches:
-            shell('git push %s :%s' % (remote_name,branch))
+            self.git('push', remote_name, ':%s' % branch)
+
+    def is_ancestor(self, ancestor, revision):
+        return self.git('merge-base', '--is-ancestor', ancestor, revision).returncode == 0
 
     def get_commits(self, revision_start, revision_end, first_parent=True, reverse=True, no_merges=False):
-        os.chdir(self.directory)
-        options = ''
-        commit_list = list()
+        # Hash, parents and body of the whole range come from a single
+        # git log stream; merge subcommits are expanded from the same data
+        options = list()
         log.debug("Interval: %s..%s" % (revision_start, revision_end))
 
-        os.chdir(self.directory)
-        shell('git checkout parking')
-        if reverse:
-            options = '%s --reverse' % options
-        if first_parent and not no_merges:
-            options = '%s --first-parent' % options
         if no_merges:
-            options = '%s --no-merges' % options
-        cmd = shell('git rev-list %s --pretty="%%H" %s..%s | grep -v ^commit' % (options, revision_start, revision_end))
+            options.append('--no-merges')
+        cmd = self.git('log', '-z', '--pretty=format:%H%x1f%P%x1f%B', *(options + ['%s..%s' % (revision_start, revision_end)]), output_mode=TEXT, show_stdout=False)
+        commits = self.parse_log_records(cmd.output)
+        # in a shallow history the range may end on the shallow boundary
+        # instead of revision_start
+        if (cmd.returncode != 0 or self.range_truncated(revision_start, commits)) and self.deepen():
+            return self.get_commits(revision_start, revision_end, first_parent=first_parent, reverse=reverse, no_merges=no_merges)
 
-        for commit_hash in cmd.output:
+        if first_parent and not no_merges:
+            commit_list = self.first_parent_chain(commits)
+        else:
+            commit_list = list(commits.values())
+        if reverse:
+            commit_list.reverse()
+
+        return [self.expand_merge(commits, commit) for commit in commit_list]
+
+    def range_truncated(self, revision_start, commits):
+        # A boundary commit inside the range is fine when its parents are
+        # revision_start or in the range, as the child of the tag excluded
+        # by --shallow-exclude. The raw commit still records the parents
+        boundary = self.shallow_commits() & set(commits)
+        if not boundary:
+            return False
+        start = self.objects.commit(revision_start)
+        for commit_hash in boundary:
+            for parent in self.objects.commit(commit_hash)['parents']:
+                if parent not in commits and (start is None or parent != start['hash']):
+                    return True
+        return False
+
+    def parse_log_records(self, log_output):
+        commits = OrderedDict()
+        for record in log_output.split('\0'):
+            if not record.strip('\n'):
+                continue
+            commit_hash, parents, body = record.strip('\n').split('\x1f', 2)
             commit = dict()
             commit['hash'] = commit_hash
-            cmd = shell('git show -s --pretty="%%P" %s' % commit_hash)
-            commit['parents'] = cmd.output[0].split(' ')
-            cmd = shell('git show -s --pretty="%%B" %s' % commit_hash)
-            commit['body'] = cmd.output
-            if len(commit['parents']) > 1:
-                commit['subcommits'] = self.get_commits(commit['parents'][0], commit['parents'][1], first_parent=False, reverse=False)
-
-            commit_list.append(commit)
-
-        return commit_list
+            commit['parents'] = parents.split(' ') if parents else []
+            commit['body'] = [line for line in body.split('\n') if line]
+            commits[commit_hash] = commit
+        return commits
+
+    def first_parent_chain(self, commits):
+        # the range tip is the only commit that is nobody's parent
+        parents = set()
+        for commit in commits.values():
+            parents.update(commit['parents'])
+        tips = [commit_hash for commit_hash in commits if commit_hash not in parents]
+        chain = list()
+        commit_hash = tips[0] if tips else None
+        while commit_hash in commits:
+            chain.append(commits[commit_hash])
+            commit_hash = commits[commit_hash]['parents'][0] if commits[commit_hash]['parents'] else None
+        return chain
+
+    def ancestors(self, commits, revision):
+        found = set()
+        pending = [revision]
+        while pending:
+            commit_hash = pending.pop()
+            if commit_hash in found or commit_hash not in commits:
+                continue
+            found.add(commit_hash)
+            pending.extend(commits[commit_hash]['parents'])
+        return found
+
+    def expand_merge(self, commits, commit):
+        commit = dict(commit)
+        if len(commit['parents']) > 1:
+            # equivalent of rev-list parent0..parent1, in log order
+            merged = self.ancestors(commits, commit['parents'][1]) - self.ancestors(commits, commit['parents'][0])
+            commit['subcommits'] = [self.expand_merge(commits, commits[commit_hash]) for commit_hash in commits if commit_hash in merged]
+        return commit
 
     def commits_differ(self, revision_a, revision_b):
-        cmd =  shell('git show --pretty=format:"%%b" %s' % revision_a)
-        body_a = '\n'.join(cmd.output)
-        cmd =  shell('git show --pretty=format:"%%b" %s' % revision_b)
-        body_b = '\n'.join(cmd.output)
-        hash_a = hashlib.sha1(body_a).hexdigest()
-        hash_b = hashlib.sha1(body_b).hexdigest()
-        return hash_a != hash_b
-
-    def find_latest_tag(self,branch):
-        os.chdir(self.directory)
-        cmd = shell('git rev-list %s' % branch, show_stdout=False)
-        for revision in cmd.output:
-            cmd = shell('git tag --points-at %s' % revision)
-            if cmd.output:
-                latest_tag = cmd.output[0]
+        # different messages are enough, diffs are compared only when needed
+        lines_a = [line for line in self.objects.commit(revision_a)['body'].split('\n') if line]
+        lines_b = [line for line in self.objects.commit(revision_b)['body'].split('\n') if line]
+        if lines_a != lines_b:
+            return True
+        return self.fingerprint(revision_a) != self.fingerprint(revision_b)
+
+    def fingerprint(self, revision):
+        # commits are immutable, git show runs only for never seen ones
+        revision = self.objects.resolve(revision)
+        fingerprint = self.fingerprints.get(revision)
+        if fingerprint is None:
+            cmd = self.git('show', '--pretty=format:%b', revision, show_stdout=False)
+            fingerprint = hashlib.sha1('\n'.join(cmd.output)).hexdigest()
+            self.fingerprints.put(revision, fingerprint)
+        return fingerprint
+
+    def get_tag_map(self):
+        # commit -> tags pointing at it, annotated tags are peeled
+        if self.tag_map is None:
+            self.tag_map = dict()
+            cmd = self.git('for-each-ref', '--format=%(objectname) %(*objectname) %(refname:short)', 'refs/tags', show_stdout=False)
+            for line in cmd.output:
+                objectname, peeled, tag = line.split(' ', 2)
+                self.tag_map.setdefault(peeled or objectname, []).append(tag)
+            for tags in self.tag_map.values():
+                tags.sort()
+        return self.tag_map
+
+    def find_latest_tag(self, branch):
+        tag_map = self.get_tag_map()
+        tags_digest = hashlib.sha1(repr(sorted(tag_map.items()))).hexdigest()
+        memo_key = "%s-%s" % (self.objects.resolve(branch), tags_digest)
+        if memo_key in self.latest_tags:
+            return self.latest_tags[memo_key]
+
+        latest_tag = None
+        for revision in stream(['git', 'rev-list', branch], cwd=self.directory):
+            if revision in tag_map:
+                latest_tag = tag_map[revision][0]
                 break
+        if latest_tag is None and self.deepen():
+            return self.find_latest_tag(branch)
+
+        if len(self.latest_tags) > 256:
+            self.latest_tags = dict()
+        self.latest_tags[memo_key] = latest_tag
+        save_json(os.path.join(self.cache_dir, 'latest-tags.json'), self.latest_tags)
         return latest_tag
 
 class LocalRepo(Git):
 
-    def __init__(self, project_name, directory):
-        super(LocalRepo, self).__init__(directory)
+    def __init__(self, project_name, directory, cherrypick_mode='worktree', object_store=None):
+        super(LocalRepo, self).__init__(directory, object_store=object_store)
         self.project_name = project_name
-        shell('git config diff.renames copy')
-        shell('git config diff.renamelimit 10000')
-        shell('git config merge.conflictstyle diff3')
+        # worktree: git cherry-pick in a worktree dedicated to the branch
+        # in-memory: merge-tree/commit-tree on the object database only
+        if cherrypick_mode == 'in-memory' and git_version() < IN_MEMORY_GIT_VERSION:
+            log.warning("in-memory cherry-pick needs git %s or later, using worktree mode" % '.'.join(str(number) for number in IN_MEMORY_GIT_VERSION))
+            cherrypick_mode = 'worktree'
+        self.cherrypick_mode = cherrypick_mode
+        self.git('config', 'diff.renames', 'copy')
+        self.git('config', 'diff.renamelimit', '10000')
+        self.git('config', 'merge.conflictstyle', 'diff3')
         # TODO: remove all local branches
         # git for-each-ref --format="%(refname)" refs/heads | sed -e "s/refs\/heads//"
         # for branch in local_branches:
-        #    shell('git branch -D %s' % branch)
+        #    self.git('branch', '-D', branch)
         self.mirror_remote = None
-        cmd = shell('git checkout parking')
+        self.equivalence_indexes = dict()
+        # the main checkout stays on parking, picks are done in per branch
+        # worktrees, so branches can be worked on at the same time
+        self.worktrees_dir = os.path.join(self.directory, '.git', 'sf-worktrees')
+        self.worktrees_lock = threading.Lock()
+        cmd = self.git('checkout', 'parking')
         if cmd.returncode != 0:
-            shell('git checkout --orphan parking')
-            shell('git commit --allow-empty -a -m "parking"')
+            self.git('checkout', '--orphan', 'parking')
+            self.git('commit', '--allow-empty', '-a', '-m', 'parking')
 
-    def set_original(self, repo_type, location, project_name, fetch=True):
+    def set_original(self, repo_type, location, project_name, fetch=True, partial_clone=False):
         self.original_type = repo_type
         if repo_type == 'gerrit':
-            self.add_gerrit_remote(self, 'original', location, project_name, fetch=fetch, fetch_changes=False)
+            self.add_gerrit_remote(self, 'original', location, project_name, fetch=fetch, fetch_changes=False, partial_clone=partial_clone)
         elif repo_type == 'git':
-            self.add_git_remote(self, 'original', location, project_name, fetch=fetch)
+            self.add_git_remote(self, 'original', location, project_name, fetch=fetch, partial_clone=partial_clone)
         else:
             log.critical('unknown original repo type')
             raise UnknownError
         self.original_remote = self.remotes['original']
 
-    def set_replica(self, location, project_name, fetch=True):
-        self.add_gerrit_remote(self, 'replica',  location, project_name, fetch=fetch, fetch_changes=fetch)
+    def set_replica(self, location, project_name, fetch=True, partial_clone=False):
+        self.add_gerrit_remote(self, 'replica',  location, project_name, fetch=fetch, fetch_changes=fetch, partial_clone=partial_clone)
         self.replica_remote = self.remotes['replica']
         self.patches_remote = self.remotes['replica']
 
@@ -169,16 +391,14 @@ class LocalRepo(Git):
         service_branches = self.list_branches('replica', pattern='failed-cherrypicks/*')
         self.delete_remote_branches('replica', service_branches)
 
-    def find_equivalent_commit(self, revision, branch):
-        cmd = shell('git show -s --pretty=format:"%%an <%%ae>" %s' % revision)
-        author = cmd.output[0]
-        cmd = shell('git show -s --pretty=format:"%%at" %s' % revision)
-        date = cmd.output[0]
-        cmd = shell('git log --pretty=raw --author="%s" %s| grep -B 3 "%s" | grep commit\  | sed -e "s/commit //g"' % (author, branch, date))
-        if cmd.output:
-            return cmd.output[0]
-        else:
-            return None
+    def equivalence_index(self, branch, base=None):
+        tip = self.objects.resolve(branch)
+        if (tip, base) not in self.equivalence_indexes:
+            self.equivalence_indexes[(tip, base)] = EquivalenceIndex(self, tip, base=base)
+        return self.equivalence_indexes[(tip, base)]
+
+    def find_equivalent_commit(self, revision, branch, base=None):
+        return self.equivalence_index(branch, base=base).lookup(revision)
 
     def add_conflicts_string(self, conflicts, commit_message):
         conflicts_string = "\nConflicts:\n  "
@@ -188,67 +408,191 @@ class LocalRepo(Git):
 
 
     def create_branch(self, branch_name, base_ref):
-        os.chdir(self.directory)
-
-        cmd = shell(' git rev-parse %s' % (base_ref))
-        base_revision = cmd.output[0]
-
-        cmd = shell('git branch --list %s' % branch_name)
-        if cmd.output:
-            cmd = shell('git branch -D %s' % branch_name)
+        base_revision = self.objects.resolve(base_ref)
+        if base_revision is None:
+            raise GitCommandError('cannot create branch %s: %s does not resolve to a commit' % (branch_name, base_ref))
 
-        cmd = shell('git checkout -b %s %s' % (branch_name, base_revision))
+        # worktrees never have the branch checked out, it can always be moved
+        cmd = self.git('branch', '-f', branch_name, base_revision)
+        self.objects.invalidate()
+        if cmd.returncode != 0:
+            raise GitCommandError('creation of branch %s failed:%s' % (branch_name, '\n    '.join([''] + cmd.errors)))
 
         return branch_name
 
     def cherrypick(self, branch, pick_revision, permanent_patches=None):
-
-        os.chdir(self.directory)
-        cmd = shell('git checkout %s' % (branch))
-        cmd = shell('git cherry-pick %s' % (pick_revision))
+        # the pick parent may be past the shallow boundary
+        parents = self.objects.commit(pick_revision)['parents']
+        while parents and self.objects.commit(parents[0]) is None and self.deepen():
+            pass
+        if self.cherrypick_mode == 'in-memory':
+            return self.cherrypick_in_memory(branch, pick_revision)
+
+        # the pick is done on a detached HEAD, the branch is moved to the
+        # result only if it succeeds
+        worktree = self.worktree(branch)
+        head = self.objects.resolve('refs/heads/%s' % branch)
+        cmd = self.git('checkout', '--force', '--detach', head, cwd=worktree)
+        if cmd.returncode != 0:
+            raise GitCommandError('checkout of %s in worktree %s failed:%s' % (branch, worktree, '\n    '.join([''] + cmd.errors)))
+        cmd = self.git('cherry-pick', pick_revision, cwd=worktree)
 
         if cmd.returncode != 0:
-            diffs = {}
             log.error("Cherry Pick Failed")
-            status = ''
-            cmd = shell('git status --porcelain')
-            conflicts = cmd.output
+            # -z: paths are not quoted
+            cmd = self.git('status', '--porcelain', '-z', cwd=worktree, output_mode=TEXT)
+            entries = porcelain_entries(cmd.output)
+            status = '\n    '.join([''] + ["%s %s" % entry for entry in entries])
+            unmerged = [path for code, path in entries if code in UNMERGED_STATUS]
+            diffs = conflict_reports(unmerged, lambda filename: open_conflict_file(os.path.join(worktree, filename)))
+            cmd = self.git('cherry-pick', '--abort', cwd=worktree)
+            raise CherryPickFailed(status, diffs)
+        picked = self.git('rev-parse', 'HEAD', cwd=worktree, output_mode=SINGLE_VALUE).output
+        cmd = self.git('update-ref', '-m', 'cherry-pick %s' % pick_revision, 'refs/heads/%s' % branch, picked, head)
+        self.objects.invalidate()
+        if cmd.returncode != 0:
+            raise GitCommandError('update of branch %s failed:%s' % (branch, '\n    '.join([''] + cmd.errors)))
+
+    def worktree_name(self, branch):
+        return re.sub('[^A-Za-z0-9._-]', '_', branch)
+
+    def worktree(self, branch):
+        # worktree for the branch, created on first use and reused by the
+        # following polls. It shares the object store with the main checkout
+        path = os.path.join(self.worktrees_dir, self.worktree_name(branch))
+        with self.worktrees_lock:
+            if not os.path.exists(os.path.join(path, '.git')):
+                # leftovers of a worktree removed by hand
+                self.git('worktree', 'prune')
+                shutil.rmtree(path, ignore_errors=True)
+                log.info("creating worktree for branch %s in %s" % (branch, path))
+                cmd = self.git('worktree', 'add', '--detach', path, 'refs/heads/%s' % branch)
+                if cmd.returncode != 0:
+                    raise GitCommandError('creation of worktree %s failed:%s' % (path, '\n    '.join([''] + cmd.errors)))
+        return path
+
+    def prune_worktrees(self, branches):
+        # removes the worktrees of branches no longer polled
+        keep = set(self.worktree_name(branch) for branch in branches)
+        with self.worktrees_lock:
+            try:
+                names = os.listdir(self.worktrees_dir)
+            except OSError:
+                names = list()
+            for name in names:
+                if name not in keep:
+                    path = os.path.join(self.worktrees_dir, name)
+                    log.info("removing worktree %s" % path)
+                    self.git('worktree', 'remove', '--force', path)
+                    shutil.rmtree(path, ignore_errors=True)
+            self.git('worktree', 'prune')
+
+    def cherrypick_in_memory(self, branch, pick_revision):
+        # Three way merge of the pick onto the branch tip, with the pick
+        # parent as base, done by git merge-tree (git >= 2.40) without any
+        # checkout. The result tree is committed with the pick author and
+        # message, then the branch ref is moved. Conflicted files are read
+        # back from the merge result tree only to build the failure report
+        pick = self.objects.commit(pick_revision)
+        head = self.objects.resolve('refs/heads/%s' % branch)
+        if not pick['parents']:
+            raise CherryPickFailed('cannot pick root commit %s' % pick['hash'], {})
+        cmd = self.git('merge-tree', '--write-tree', '--merge-base=%s' % pick['parents'][0], head, pick['hash'])
+        if cmd.returncode not in (0, 1) or not cmd.output:
+            raise GitCommandError('merge-tree of %s on %s failed:%s' % (pick['hash'], branch, '\n    '.join([''] + cmd.errors)))
+        tree = cmd.output[0]
+
+        if cmd.returncode == 1:
+            log.error("Cherry Pick Failed")
+            # conflicted file info: <mode> <object> <stage>\t<file>
+            stages = OrderedDict()
+            for line in cmd.output[1:]:
+                if '\t' not in line:
+                    break
+                info, filename = line.split('\t', 1)
+                stages.setdefault(filename, set()).add(info.split(' ')[2])
+            conflicts = ["%s %s" % (conflict_status(file_stages), filename) for filename, file_stages in stages.items()]
             status = '\n    '.join([''] + conflicts)
-            # TODO: add diff3 conflict blocks to output to status
-            for filestatus in conflicts:
-                filename = re.sub("^[A-Z]{1,2}\s+", "", filestatus) # re.sub('^[A-Z]*\ ', '')
-                block_start = None
-                block_end = None
-                with open(filename) as conflict_file:
-                    filecontent = conflict_file.read()
-                for lineno, line in enumerate(filecontent.split('\n')):
-                    rs = re.search('^<<<<<<<', line)
-                    if rs is not None:
-                        block_start = lineno
-                    rs = re.search('^>>>>>>>', line)
-                    if rs is not None:
-                        block_end = lineno
-                    if block_start is not None and block_end is not None:
-                        block = '\n'.join(filecontent.split('\n')[block_start:block_end+1])
-                        diffs[filename] = block
-            cmd = shell('git cherry-pick --abort')
+            diffs = conflict_reports(stages, lambda filename: StringIO.StringIO(self.objects.blob('%s:%s' % (tree, filename)) or ''))
             raise CherryPickFailed(status, diffs)
-        cmd = shell('git checkout parking')
+
+        if tree == self.objects.commit(head)['tree']:
+            log.error("Cherry Pick Failed")
+            raise CherryPickFailed('\n    pick of %s on %s is empty' % (pick['hash'], branch), {})
+
+        author_name, author_email = re.match('(.*) <(.*)>$', pick['author']).groups()
+        env = dict(os.environ)
+        env['GIT_AUTHOR_NAME'] = author_name
+        env['GIT_AUTHOR_EMAIL'] = author_email
+        env['GIT_AUTHOR_DATE'] = "%s %s" % (pick['author_date'], pick['author_tz'])
+        cmd = self.git('commit-tree', tree, '-p', head, '-F', '-', stdin=pick['message'], env=env, output_mode=SINGLE_VALUE)
+        if cmd.returncode != 0:
+            raise GitCommandError('commit-tree of %s failed:%s' % (pick['hash'], '\n    '.join([''] + cmd.errors)))
+        cmd = self.git('update-ref', '-m', 'cherry-pick %s' % pick['hash'], 'refs/heads/%s' % branch, cmd.output, head)
+        self.objects.invalidate()
+        if cmd.returncode != 0:
+            raise GitCommandError('update of branch %s failed:%s' % (branch, '\n    '.join([''] + cmd.errors)))
 
     def remove_commits(self, branch, removed_commits, remote=''):
-        shell('git branch --track %s%s %s' (remote, branch, branch))
-        shell('git checkout %s' % branch)
+        self.git('branch', '--track', '%s%s' % (remote, branch), branch)
+        self.git('checkout', branch)
         for commit in removed_commits:
-            cmd = shell('git show -s %s' % commit)
+            cmd = self.git('show', '-s', commit)
             if cmd.output:
-                shell('git rebase -p --onto %s^ %s' % (commit, commit))
+                self.git('rebase', '-p', '--onto', '%s^' % commit, commit)
                 log.info('removed commit %s from branch %s' % (commit, branch))
             else:
                 break
         if remote:
-            shell('git push -f %s HEAD:%s' % (remote, branch))
+            self.git('push', '-f', remote, 'HEAD:%s' % branch)
             log.info('Pushed modified branch on remote')
-        shell('git checkout parking')
+        self.git('checkout', 'parking')
+        self.objects.invalidate()
+
+def git_version():
+    # (major, minor, ...) of the git in use
+    output = run(['git', '--version'], output_mode=SINGLE_VALUE).output or ''
+    match = re.search('(\d+(\.\d+)+)', output)
+    if match is None:
+        return ()
+    return tuple(int(number) for number in match.group(1).split('.'))
+
+
+def porcelain_entries(output):
+    # (XY code, path) of git status --porcelain -z output. Renames and
+    # copies are followed by the original path, which is skipped
+    entries = list()
+    fields = iter(output.split('\0'))
+    for field in fields:
+        if not field:
+            continue
+        code, path = field[:2], field[3:]
+        entries.append((code, path))
+        if code[0] in 'RC':
+            next(fields, None)
+    return entries
+
+
+def open_conflict_file(path):
+    # files deleted on one side have no conflict markers to read
+    try:
+        return open(path)
+    except IOError:
+        return StringIO.StringIO('')
+
+
+def conflict_status(stages):
+    # same two letter codes as git status --porcelain for unmerged paths
+    codes = {
+        ('1', '2', '3'): 'UU',
+        ('2', '3'): 'AA',
+        ('1', '2'): 'UD',
+        ('1', '3'): 'DU',
+        ('2',): 'AU',
+        ('3',): 'UA',
+    }
+    return codes.get(tuple(sorted(stages)), 'UU')
+
 
 class TrackedRepo(Git):
 
@@ -257,6 +601,7 @@ class TrackedRepo(Git):
         self.directory = directory
         self.project_name = project_name
         self.localrepo = localrepo
+        self.objects = localrepo.objects
 
     def get_changes(self, search_values, search_field='commit', results_key='revision', branch=None, raw_data=False, single_result=False):
         if type(search_values) is str or type(search_values) is unicode:
@@ -267,12 +612,11 @@ class TrackedRepo(Git):
             return None
 
         changes_data = OrderedDict()
-        os.chdir(self.directory)
         for revision in search_values:
             infos = {}
-            cmd = shell('git show -s --pretty=format:"%%H %%P" %s' % (revision))
-            infos['id'] = cmd.output[0].split(' ')[0]
-            infos['parents'] = cmd.output[0].split(' ')[1:]
+            commit = self.objects.commit(revision)
+            infos['id'] = commit['hash']
+            infos['parents'] = commit['parents']
             infos['revision'] = infos['id']
             if not branch:
                 log.error("for git repositories you must specify a branch")
@@ -0,0 +1,78 @@
+import contextlib
+import fcntl
+import os
+from shellcommand import run
+from ..colorlog import log
+
+
+# Bare repository shared by all the projects in base dir. Project
+# repositories list its object directory in objects/info/alternates, their
+# remotes are first fetched in here under a per project namespace, so
+# history common to several projects, or to replica and original, is
+# downloaded and stored once. Whatever is borrowed must never be deleted:
+# the namespaced refs keep it reachable, automatic gc is off and gc runs
+# only through maintain, which never prunes.
+# fetch output is only logged
+MAX_FETCH_OUTPUT = 1048576
+
+
+class SharedObjectStore(object):
+
+    # loose objects before maintain repacks
+    gc_threshold = 6700
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self.objects_dir = os.path.join(self.directory, 'objects')
+        self.lock_path = self.directory + '.lock'
+        if not os.path.exists(os.path.join(self.directory, 'HEAD')):
+            with self.locked():
+                if not os.path.exists(os.path.join(self.directory, 'HEAD')):
+                    log.info("creating shared object store in %s" % self.directory)
+                    run(['git', 'init', '--bare', self.directory])
+                    self.git('config', 'gc.auto', '0')
+                    self.git('config', 'gc.pruneExpire', 'never')
+
+    def git(self, *args, **kwargs):
+        return run(['git'] + list(args), cwd=self.directory, **kwargs)
+
+    @contextlib.contextmanager
+    def locked(self):
+        # exclusive between threads and between processes: every user
+        # opens its own file description
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def link(self, git_dir):
+        alternates_path = os.path.join(git_dir, 'objects', 'info', 'alternates')
+        try:
+            with open(alternates_path) as alternates_file:
+                alternates = alternates_file.read().split('\n')
+        except IOError:
+            alternates = list()
+        if self.objects_dir in alternates:
+            return
+        log.info("borrowing objects of %s from %s" % (git_dir, self.objects_dir))
+        try:
+            os.makedirs(os.path.dirname(alternates_path))
+        except OSError:
+            pass
+        with open(alternates_path, 'a') as alternates_file:
+            alternates_file.write("%s\n" % self.objects_dir)
+
+    def fetch(self, url, namespace, refspecs, timeout=None):
+        # refspecs are mapped below refs/<namespace>/, refs of different
+        # projects never collide
+        mapped = ['+%s:refs/%s/%s' % (source, namespace, destination) for source, destination in refspecs]
+        with self.locked():
+            cmd = self.git('fetch', '--no-tags', url, *mapped, timeout=timeout, max_output=MAX_FETCH_OUTPUT)
+        return cmd.returncode == 0
+
+    def maintain(self):
+        with self.locked():
+            cmd = self.git('-c', 'gc.auto=%d' % self.gc_threshold, 'gc', '--auto', '--prune=never')
+        return cmd.returncode == 0
@@ -1,38 +1,281 @@
+import os
 import subprocess
+import threading
+import time
 from ..colorlog import log
+from .. import metrics
+from .. import trace
+from ..exceptions import CommandError
 
-def shell(commandline, stdin=None, show_stdout=True, show_stderr=True, remove_blank=True, output_mode="list"):
-    # TODO: implement output_mode = LIST, TEXT, SINGLE_LINE, SINGLE_VALUE
-    process = subprocess.Popen(commandline, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
+# output modes:
+#   LIST: stdout lines, blank lines removed unless remove_blank=False
+#   TEXT: stdout as a single string
+#   SINGLE_LINE: first non blank stdout line, or None
+#   SINGLE_VALUE: whole stdout stripped, or None if empty. Meant for
+#       rev-parse style calls: nothing is split or logged line by line
+LIST = 'list'
+TEXT = 'text'
+SINGLE_LINE = 'single_line'
+SINGLE_VALUE = 'single_value'
+
+READ_SIZE = 65536
+
+
+class CommandResult(object):
+
+    def __init__(self, argv):
+        self.argv = argv
+        self.commandline = ' '.join(argv)
+        self.returncode = None
+        self.output = None
+        self.errors = None
+        self.truncated = False
+        self.timed_out = False
+
+
+class PipeReader(threading.Thread):
+    # drains a pipe, keeping at most max_size bytes
+
+    def __init__(self, pipe, max_size=None):
+        super(PipeReader, self).__init__()
+        self.daemon = True
+        self.pipe = pipe
+        self.max_size = max_size
+        self.chunks = list()
+        self.size = 0
+        self.truncated = False
+
+    def run(self):
+        for chunk in iter(lambda: self.pipe.read(READ_SIZE), ''):
+            if self.max_size is not None and self.size + len(chunk) > self.max_size:
+                chunk = chunk[:self.max_size - self.size]
+                self.truncated = True
+            self.chunks.append(chunk)
+            self.size = self.size + len(chunk)
+        self.pipe.close()
+
+    def text(self):
+        return ''.join(self.chunks)
+
+
+class Timeout(object):
+    # kills the processes if they are still running after timeout seconds
+
+    def __init__(self, processes, timeout):
+        self.processes = processes
+        self.expired = False
+        self.timer = None
+        if timeout is not None:
+            self.timer = threading.Timer(timeout, self.kill)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def kill(self):
+        self.expired = True
+        for process in self.processes:
+            if process.poll() is None:
+                process.kill()
+
+    def cancel(self):
+        if self.timer is not None:
+            self.timer.cancel()
+
+
+def start_pipeline(commands, stdin, stdout, stderr, cwd, env):
+    # every command reads the stdout of the previous one
+    # if a command can't be started (missing binary or cwd) the ones
+    # already running are killed before the OSError goes on
+    processes = list()
+    try:
+        for index, argv in enumerate(commands):
+            if processes:
+                command_stdin = processes[-1].stdout
+            else:
+                command_stdin = stdin
+            if index == len(commands) - 1:
+                command_stdout = stdout
+            else:
+                command_stdout = subprocess.PIPE
+            processes.append(subprocess.Popen(argv, stdin=command_stdin, stdout=command_stdout, stderr=stderr, cwd=cwd, env=env, close_fds=True))
+            if len(processes) > 1:
+                # the next command owns the pipe now
+                processes[-2].stdout.close()
+    except OSError:
+        for process in processes:
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+            for pipe in (process.stdin, process.stdout, process.stderr):
+                if pipe is not None:
+                    pipe.close()
+        raise
+    return processes
+
+
+def pipeline(commands, stdin=None, cwd=None, env=None, timeout=None, output_mode=LIST, max_output=None, show_stdout=True, show_stderr=True, remove_blank=True):
+    result = CommandResult([arg for argv in commands for arg in argv + ['|']][:-1])
+    devnull = open(os.devnull, 'r+')
     if stdin is not None:
-        process.stdin.write(stdin)
-    process.output, process.errors = process.communicate()
-    process.output = process.output.split('\n')
-    process.errors = process.errors.split('\n')
-    if process.returncode == 0:
-        outlog = log.success
+        first_stdin = subprocess.PIPE
+    else:
+        first_stdin = devnull
+    start = time.time()
+    try:
+        processes = start_pipeline(commands, first_stdin, subprocess.PIPE, subprocess.PIPE, cwd, env)
+    except OSError, e:
+        # a shell would exit with 127 too
+        devnull.close()
+        result.returncode = 127
+        end = time.time()
+        metrics.observe_command(commands[0], end - start, True)
+        trace.command(commands[0], start, end, True)
+        log_result(result, '', str(e), output_mode, show_stdout, show_stderr)
+        return set_output(result, '', str(e), output_mode, remove_blank)
+    timer = Timeout(processes, timeout)
+
+    if output_mode == SINGLE_VALUE and stdin is None and len(processes) == 1:
+        output, errors = processes[0].communicate()
+        stdout_reader = None
+    else:
+        if stdin is not None:
+            feeder = threading.Thread(target=feed, args=(processes[0].stdin, stdin))
+            feeder.daemon = True
+            feeder.start()
+        stdout_reader = PipeReader(processes[-1].stdout, max_size=max_output)
+        stdout_reader.start()
+        # stderr of all the commands is merged
+        stderr_readers = list()
+        for process in processes:
+            stderr_reader = PipeReader(process.stderr, max_size=max_output)
+            stderr_reader.start()
+            stderr_readers.append(stderr_reader)
+        for process in processes:
+            process.wait()
+        stdout_reader.join()
+        for stderr_reader in stderr_readers:
+            stderr_reader.join()
+        output = stdout_reader.text()
+        errors = ''.join([stderr_reader.text() for stderr_reader in stderr_readers])
+        result.truncated = stdout_reader.truncated
+
+    timer.cancel()
+    devnull.close()
+    result.timed_out = timer.expired
+    # like a shell pipeline, the last command sets the exit status
+    result.returncode = processes[-1].returncode
+    # pipelines are accounted to their first command
+    end = time.time()
+    metrics.observe_command(commands[0], end - start, result.returncode != 0 or result.timed_out)
+    trace.command(commands[0], start, end, result.returncode != 0 or result.timed_out)
+    if result.timed_out:
+        errors = errors + "\n*** Killed after %s seconds" % timeout
+    if result.truncated:
+        log.warning("output of %s truncated at %d bytes" % (result.commandline, max_output))
+
+    log_result(result, output, errors, output_mode, show_stdout, show_stderr)
+    return set_output(result, output, errors, output_mode, remove_blank)
+
+
+def set_output(result, output, errors, output_mode, remove_blank):
+    result.errors = errors.split('\n')
+    if output_mode == TEXT:
+        result.output = output
+    elif output_mode == SINGLE_VALUE:
+        result.output = output.strip() or None
+    else:
+        result.output = output.split('\n')
+        if remove_blank:
+            # remove blank lines from output for further processing
+            result.output = [line for line in result.output if line != '']
+            result.errors = [line for line in result.errors if line != '']
+        if output_mode == SINGLE_LINE:
+            if result.output:
+                result.output = result.output[0]
+            else:
+                result.output = None
+    return result
+
+
+def run(argv, **kwargs):
+    return pipeline([argv], **kwargs)
+
+
+def feed(pipe, data):
+    try:
+        pipe.write(data)
+    except IOError:
+        pass
+    pipe.close()
+
+
+def log_result(result, output, errors, output_mode, show_stdout, show_stderr):
+    # one record per stream, formatted only if a handler wants it: output
+    # of successful commands is debug information
+    if result.returncode == 0:
+        outlog = log.debug
     else:
         outlog = log.error
-    log.info("---- executing command: %s" % commandline)
-    log.info("---- stdout:")
+    log.info("---- executing command: %s", result.commandline)
+    if output_mode == SINGLE_VALUE:
+        outlog("---- value: %s", output.strip())
+        return
     if show_stdout:
-        for line in process.output:
-            outlog(line)
+        outlog("---- stdout:\n%s", output)
     else:
-        outlog("*** Suppressed")
-    log.info("---- stderr:")
+        outlog("---- stdout: *** Suppressed")
     if show_stderr:
-        for line in process.errors:
-            outlog(line)
+        outlog("---- stderr:\n%s", errors)
     else:
-        outlog("*** Suppressed")
+        outlog("---- stderr: *** Suppressed")
     log.info("---- end command")
-    if remove_blank:
-        # remove blank lines from output for further processing
-        while '' in process.output:
-            process.output.remove('')
-        while '' in process.errors:
-            process.errors.remove('')
-    return process
 
 
+def stream(argv, cwd=None, env=None, timeout=None, check=False):
+    # yields stdout lines as they are produced, the command is killed if
+    # the caller stops iterating early. With check, CommandError is raised
+    # once the output is over if the command failed or timed out
+    log.info("---- streaming command: %s", ' '.join(argv))
+    devnull = open(os.devnull, 'r')
+    start = time.time()
+    try:
+        process = subprocess.Popen(argv, stdin=devnull, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd, env=env, close_fds=True)
+    except OSError, e:
+        devnull.close()
+        end = time.time()
+        metrics.observe_command(argv, end - start, True)
+        trace.command(argv, start, end, True)
+        log.error("---- stderr:\n%s", e)
+        log.info("---- end command")
+        if check:
+            raise CommandError("%s: %s" % (' '.join(argv), e))
+        return
+    stderr_reader = PipeReader(process.stderr)
+    stderr_reader.start()
+    timer = Timeout([process], timeout)
+    # the output can end before the process exits
+    finished = False
+    try:
+        for line in iter(process.stdout.readline, ''):
+            yield line.rstrip('\n')
+        finished = True
+    finally:
+        stopped = not finished and process.poll() is None
+        if stopped:
+            process.kill()
+        process.wait()
+        timer.cancel()
+        # stopping early is not a failure of the command
+        failed = timer.expired or (not stopped and process.returncode != 0)
+        end = time.time()
+        metrics.observe_command(argv, end - start, failed)
+        trace.command(argv, start, end, failed)
+        stderr_reader.join()
+        devnull.close()
+        errors = stderr_reader.text()
+        if errors:
+            log.error("---- stderr:\n%s", errors)
+        log.info("---- end command")
+    if check and failed:
+        if timer.expired:
+            raise CommandError("%s: killed after %s seconds" % (' '.join(argv), timeout))
+        raise CommandError("%s: exit status %s" % (' '.join(argv), process.returncode))
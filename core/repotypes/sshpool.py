@@ -0,0 +1,64 @@
+import os
+import shlex
+import tempfile
+import threading
+from shellcommand import run
+from ..colorlog import log
+
+
+# All the ssh connections to a host go through one OpenSSH master per host:
+# the first command authenticates and leaves a control socket behind, the
+# following ones are multiplexed on it without a new TCP and key exchange.
+# The number of commands running at the same time on a host is bounded
+# per process by max_sessions.
+class SSHPool(object):
+
+    def __init__(self):
+        self.configure()
+
+    def configure(self, control_dir=None, max_sessions=4, persist=600, ssh_command='ssh'):
+        if control_dir is None:
+            control_dir = os.path.join(tempfile.gettempdir(), 'sf-repo-ssh-%d' % os.getuid())
+        self.control_dir = control_dir
+        self.max_sessions = max_sessions
+        self.persist = persist
+        self.ssh_command = ssh_command
+        self.sessions = dict()
+        self.lock = threading.Lock()
+
+    def options(self):
+        # %C is a hash of the connection parameters, it keeps socket
+        # paths short whatever the host name
+        return ['-o', 'ControlMaster=auto', '-o', 'ControlPath=%s/%%C' % self.control_dir, '-o', 'ControlPersist=%d' % self.persist]
+
+    def prepare(self):
+        try:
+            os.makedirs(self.control_dir, 0700)
+        except OSError:
+            pass
+
+    def session(self, host):
+        with self.lock:
+            if host not in self.sessions:
+                self.sessions[host] = threading.BoundedSemaphore(self.max_sessions)
+            return self.sessions[host]
+
+    def command(self, host, remote_command):
+        self.prepare()
+        return shlex.split(self.ssh_command) + self.options() + [host, remote_command]
+
+    def scp_command(self, source, destination):
+        self.prepare()
+        return ['scp', '-p'] + self.options() + [source, destination]
+
+    def git_ssh_command(self):
+        # for git fetch/push over ssh://, through GIT_SSH_COMMAND
+        self.prepare()
+        return ' '.join([self.ssh_command] + self.options())
+
+    def close(self, host):
+        log.debug("closing ssh master connection to %s" % host)
+        run(shlex.split(self.ssh_command) + self.options() + ['-O', 'exit', host])
+
+
+pool = SSHPool()
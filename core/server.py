@@ -0,0 +1,160 @@
+import json
+import os
+import Queue
+import random
+import socket
+import threading
+import time
+from colorlog import log, logsummary, set_project
+from state import state_store
+import metrics
+import trace
+
+
+# Long running poller: projects stay loaded between polls, with their
+# repositories, remotes and caches, and are polled every poll-interval
+# seconds (project setting, or the server default) plus a random jitter
+# so they do not all hit gerrit at once. A UNIX socket takes one command
+# per connection and answers with a json document:
+#   poll <project>   poll the project as soon as possible
+#   status           state of all the projects
+class Server(object):
+
+    def __init__(self, repos, fetch=True, interval=300, jitter=60, socket_path=None):
+        self.repos = repos
+        self.fetch = fetch
+        self.interval = interval
+        self.jitter = jitter
+        if socket_path is None:
+            socket_path = os.path.join(repos.base_dir, 'sf-repo.sock')
+        self.socket_path = socket_path
+        self.projects = dict()
+        self.requests = Queue.Queue()
+        self.state = state_store(repos.base_dir)
+        self.lock = threading.Lock()
+        # project name -> next poll time, the first polls are spread
+        # over the jitter interval
+        now = time.time()
+        self.schedule = dict((project_name, now + random.uniform(0, self.project_jitter(project_name))) for project_name in repos.projects)
+        self.status = dict((project_name, {'state': 'idle', 'polls': 0, 'skipped': 0, 'last-start': None, 'last-duration': None, 'last-error': None}) for project_name in repos.projects)
+
+    def project_interval(self, project_name):
+        return self.repos.projects[project_name].get('poll-interval', self.interval)
+
+    def project_jitter(self, project_name):
+        return self.repos.projects[project_name].get('poll-jitter', self.jitter)
+
+    def reschedule(self, project_name):
+        with self.lock:
+            self.schedule[project_name] = time.time() + self.project_interval(project_name) + random.uniform(0, self.project_jitter(project_name))
+
+    def poll(self, project_name, force=False):
+        # scheduled polls are skipped while the remote refs do not move,
+        # requested ones always run
+        status = self.status[project_name]
+        snapshot = None
+        if self.fetch:
+            changed, snapshot = self.repos.snapshot_changed(self.state, project_name)
+            if not changed and not force:
+                log.debug("Project %s: remote refs unchanged, poll skipped" % project_name)
+                with self.lock:
+                    status['skipped'] = status['skipped'] + 1
+                self.reschedule(project_name)
+                return
+        with self.lock:
+            status['state'] = 'polling'
+            status['last-start'] = time.time()
+        set_project(project_name)
+        error = None
+        try:
+            project = self.projects.get(project_name)
+            if project is None:
+                project = self.repos.load_project(project_name, fetch=self.fetch)
+                self.projects[project_name] = project
+            elif self.fetch:
+                project.fetch()
+            project.poll_branches()
+        except Exception, e:
+            log.exception(e)
+            logsummary.error("Project %s skipped, reason: %s" % (project_name, e))
+            error = str(e)
+            # loaded again from scratch next time
+            project = self.projects.pop(project_name, None)
+            if project is not None:
+                project.close()
+        finally:
+            set_project(None)
+        with self.lock:
+            status['state'] = 'idle'
+            status['polls'] = status['polls'] + 1
+            status['last-duration'] = time.time() - status['last-start']
+            status['last-error'] = error
+        metrics.observe_poll(project_name, status['last-duration'], error)
+        self.repos.poll_done(self.state, (project_name, True, error), {project_name: snapshot})
+        metrics.write()
+        trace.write()
+        self.reschedule(project_name)
+
+    def command(self, line):
+        words = line.split()
+        if words[:1] == ['poll'] and len(words) == 2:
+            if words[1] not in self.status:
+                return {'error': 'unknown project %s' % words[1]}
+            self.requests.put(words[1])
+            return {'queued': words[1]}
+        if words == ['status']:
+            with self.lock:
+                status = dict()
+                for project_name, project_status in self.status.items():
+                    status[project_name] = dict(project_status)
+                    status[project_name]['next-poll'] = self.schedule[project_name]
+            return status
+        return {'error': 'unknown command: %s' % line.strip()}
+
+    def serve_connection(self, connection):
+        try:
+            line = connection.makefile('r').readline()
+            connection.sendall(json.dumps(self.command(line), sort_keys=True) + '\n')
+        except socket.error, e:
+            log.warning("control connection failed: %s" % e)
+        finally:
+            connection.close()
+
+    def control(self, server_socket):
+        while True:
+            connection, address = server_socket.accept()
+            handler = threading.Thread(target=self.serve_connection, args=(connection,))
+            handler.daemon = True
+            handler.start()
+
+    def listen(self):
+        try:
+            os.unlink(self.socket_path)
+        except OSError:
+            pass
+        server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server_socket.bind(self.socket_path)
+        os.chmod(self.socket_path, 0600)
+        server_socket.listen(5)
+        listener = threading.Thread(target=self.control, args=(server_socket,), name="control")
+        listener.daemon = True
+        listener.start()
+
+    def run(self):
+        self.listen()
+        logsummary.info("Serving %d projects, control socket %s" % (len(self.schedule), self.socket_path))
+        while True:
+            try:
+                project_name = self.requests.get(timeout=1)
+                logsummary.info("Project %s: poll requested" % project_name)
+                self.poll(project_name, force=True)
+            except Queue.Empty:
+                pass
+
+            now = time.time()
+            with self.lock:
+                due = sorted((next_poll, project_name) for project_name, next_poll in self.schedule.items() if next_poll <= now)
+            for next_poll, project_name in due:
+                self.poll(project_name)
+            if due:
+                self.repos.maintain()
@@ -0,0 +1,74 @@
+import os
+import sqlite3
+import threading
+import time
+
+# results after which a branch needs no work until one of the tips moves
+DONE_RESULTS = ['up-to-date', 'uploaded']
+
+
+# What the last poll of each project branch saw and did, in a sqlite
+# database in base dir:
+#   original_tip: last original commit processed
+#   replica_tip: top of the replica chain the poll left
+#   matched: backports at the bottom of the chain matching the upstream
+#       range, in order
+#   result: up-to-date, uploaded or failed
+# and the digest of the remote refs each project was last polled for.
+# The connection is shared by the threads polling the branches of a
+# project, statements are serialized by the lock
+class StateStore(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        with self.lock:
+            with self.connection:
+                self.connection.execute('''CREATE TABLE IF NOT EXISTS branches (
+                    project TEXT NOT NULL,
+                    branch TEXT NOT NULL,
+                    base_tag TEXT,
+                    original_tip TEXT,
+                    replica_tip TEXT,
+                    matched INTEGER NOT NULL DEFAULT 0,
+                    result TEXT,
+                    updated INTEGER,
+                    PRIMARY KEY (project, branch))''')
+                self.connection.execute('''CREATE TABLE IF NOT EXISTS ref_snapshots (
+                    project TEXT PRIMARY KEY,
+                    digest TEXT NOT NULL,
+                    updated INTEGER)''')
+
+    def branch_state(self, project, branch):
+        with self.lock:
+            row = self.connection.execute('SELECT * FROM branches WHERE project = ? AND branch = ?', (project, branch)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(row.keys(), row))
+
+    def save_branch_state(self, project, branch, base_tag, original_tip, replica_tip, matched, result):
+        with self.lock:
+            with self.connection:
+                self.connection.execute('INSERT OR REPLACE INTO branches (project, branch, base_tag, original_tip, replica_tip, matched, result, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (project, branch, base_tag, original_tip, replica_tip, matched, result, int(time.time())))
+
+    def ref_snapshot(self, project):
+        with self.lock:
+            row = self.connection.execute('SELECT digest FROM ref_snapshots WHERE project = ?', (project,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def save_ref_snapshot(self, project, digest):
+        with self.lock:
+            with self.connection:
+                self.connection.execute('INSERT OR REPLACE INTO ref_snapshots (project, digest, updated) VALUES (?, ?, ?)', (project, digest, int(time.time())))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def state_store(base_dir):
+    return StateStore(os.path.join(base_dir, 'state.db'))
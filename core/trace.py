@@ -0,0 +1,154 @@
+import collections
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import metrics
+from cache import write_atomic
+
+# events kept, the oldest are dropped when a long running server fills it
+MAX_EVENTS = 1000000
+# python functions shorter than this are not recorded by the profile hook
+PROFILE_MIN_DURATION = 0.001
+PROFILED_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+# Complete events in chrome trace event format, loadable in about:tracing
+# or perfetto. Nesting comes from the timestamps of the spans of the same
+# thread, events of pool workers are merged in with their own pid
+class Tracer(object):
+
+    def __init__(self, max_events=MAX_EVENTS):
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.events = collections.deque(maxlen=max_events)
+        # (pid, tid) -> thread name
+        self.threads = dict()
+
+    def add(self, name, category, start, end, args):
+        thread = threading.current_thread()
+        event = {'name': name, 'cat': category, 'ph': 'X', 'ts': int(start * 1000000), 'dur': int((end - start) * 1000000), 'pid': self.pid, 'tid': thread.ident, 'args': args}
+        with self.lock:
+            self.events.append(event)
+            self.threads[(self.pid, thread.ident)] = thread.name
+
+    def dump(self):
+        with self.lock:
+            thread_names = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}} for (pid, tid), name in self.threads.items()]
+            return thread_names + list(self.events)
+
+    def merge(self, events):
+        with self.lock:
+            for event in events:
+                if event['ph'] == 'M':
+                    self.threads[(event['pid'], event['tid'])] = event['args']['name']
+                else:
+                    self.events.append(event)
+
+
+class Span(object):
+
+    def __init__(self, span_tracer, name, category, args):
+        self.tracer = span_tracer
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        args = metrics.labels(**self.args)
+        if exc_type is not None:
+            args['error'] = str(exc_value)
+        self.tracer.add(self.name, self.category, self.start, time.time(), args)
+
+
+class NoSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+NO_SPAN = NoSpan()
+
+# None while tracing is off: spans are then a shared object that does
+# nothing
+tracer = None
+trace_file = None
+
+
+def enable(path, profile=False):
+    global tracer, trace_file
+    tracer = Tracer()
+    trace_file = path
+    if profile:
+        sys.setprofile(profile_hook)
+        threading.setprofile(profile_hook)
+
+
+def use_tracer(new_tracer):
+    # returns the tracer in use until now
+    global tracer
+    previous = tracer
+    tracer = new_tracer
+    return previous
+
+
+def span(name, category='sf-repo', **args):
+    if tracer is None:
+        return NO_SPAN
+    return Span(tracer, name, category, args)
+
+
+def traced(name):
+    # decorator, the calls of the function are spans
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if tracer is None:
+                return function(*args, **kwargs)
+            with Span(tracer, name, 'sf-repo', dict()):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def command(argv, start, end, failed):
+    if tracer is None:
+        return
+    operation, remote = metrics.classify(argv)
+    tracer.add(operation, 'command', start, end, metrics.labels(command=' '.join(argv), remote=remote, failed=failed))
+
+
+# python level profile, sys.setprofile hook: functions of this package
+# that last at least PROFILE_MIN_DURATION become spans too
+profile_context = threading.local()
+
+
+def profile_hook(frame, event, arg):
+    if tracer is None or not frame.f_code.co_filename.startswith(PROFILED_DIR):
+        return
+    stack = getattr(profile_context, 'stack', None)
+    if stack is None:
+        stack = profile_context.stack = list()
+    if event == 'call':
+        stack.append((frame, time.time()))
+    elif event == 'return' and stack and stack[-1][0] is frame:
+        start = stack.pop()[1]
+        end = time.time()
+        if end - start >= PROFILE_MIN_DURATION:
+            code = frame.f_code
+            tracer.add(code.co_name, 'python', start, end, {'file': os.path.relpath(code.co_filename, PROFILED_DIR), 'line': code.co_firstlineno})
+
+
+def write():
+    if tracer is None:
+        return
+    write_atomic(trace_file, json.dumps({'traceEvents': tracer.dump(), 'displayTimeUnit': 'ms'}))
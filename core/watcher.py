@@ -0,0 +1,126 @@
+import json
+import Queue
+import threading
+import time
+from colorlog import log, logsummary, set_project
+from repotypes.shellcommand import stream
+from repotypes.sshpool import pool
+import metrics
+import trace
+
+WATCHED_EVENTS = ['ref-updated', 'change-merged', 'comment-added']
+# event fields naming who caused the event
+EVENT_ACCOUNTS = ['author', 'uploader', 'submitter']
+
+
+class Watcher(object):
+
+    def __init__(self, repos, fetch=True, debounce=10, reconnect_delay=30, accounts=None):
+        self.repos = repos
+        self.fetch = fetch
+        self.debounce = debounce
+        # usernames or emails sf-repo uses on gerrit: events it causes
+        # itself, like its review comments, must not trigger polls
+        self.accounts = set(accounts or [])
+        self.reconnect_delay = reconnect_delay
+        self.events = Queue.Queue()
+        # (project name, original branch) -> time of the last event
+        self.pending = dict()
+        self.projects = dict()
+
+        # (host, gerrit project, branch) -> (project name, original branch)
+        self.targets = dict()
+        for project_name, project_info in repos.projects.items():
+            original = project_info['original']
+            replica = project_info['replica']
+            for branch in original['watch-branches']:
+                replica_branch = branch.get('replica-branch', branch['name'])
+                if original['type'] == 'gerrit':
+                    self.targets[(original['location'], original['name'], branch['name'])] = (project_name, branch['name'])
+                self.targets[(replica['location'], replica['name'], replica_branch)] = (project_name, branch['name'])
+
+    def listen(self, host):
+        # runs in its own thread, stream-events is restarted when the
+        # connection drops
+        while True:
+            for line in stream(pool.command(host, 'gerrit stream-events')):
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    log.warning("Unparsable event from %s: %s" % (host, line))
+                    continue
+                if event.get('type') in WATCHED_EVENTS:
+                    self.events.put((host, event))
+            log.warning("Event stream from %s closed, reconnecting in %d seconds" % (host, self.reconnect_delay))
+            time.sleep(self.reconnect_delay)
+
+    def own_event(self, event):
+        for field in EVENT_ACCOUNTS:
+            account = event.get(field) or dict()
+            if account.get('username') in self.accounts or account.get('email') in self.accounts:
+                return True
+        return False
+
+    def event_target(self, host, event):
+        if event['type'] == 'ref-updated':
+            project = event['refUpdate']['project']
+            branch = event['refUpdate']['refName']
+            if branch.startswith('refs/heads/'):
+                branch = branch[len('refs/heads/'):]
+        else:
+            project = event['change']['project']
+            branch = event['change']['branch']
+        return self.targets.get((host, project, branch))
+
+    def poll(self, project_name, branch):
+        logsummary.info("Project %s: events on branch %s, polling" % (project_name, branch))
+        set_project(project_name)
+        try:
+            project = self.projects.get(project_name)
+            if project is None:
+                project = self.repos.load_project(project_name, fetch=self.fetch)
+                self.projects[project_name] = project
+            elif self.fetch:
+                project.fetch()
+            project.replica_repo.begin_batch()
+            try:
+                project.poll_branch(branch)
+            finally:
+                project.flush_reviews()
+        except Exception, e:
+            log.exception(e)
+            logsummary.error("Project %s branch %s skipped, reason: %s" % (project_name, branch, e))
+        finally:
+            set_project(None)
+            metrics.set_branch(None)
+        metrics.write()
+        trace.write()
+
+    def run(self):
+        hosts = set(host for host, project, branch in self.targets)
+        for host in hosts:
+            listener = threading.Thread(target=self.listen, args=(host,), name="events-%s" % host)
+            listener.daemon = True
+            listener.start()
+        logsummary.info("Watching events from %s" % ', '.join(sorted(hosts)))
+
+        while True:
+            try:
+                host, event = self.events.get(timeout=1)
+                target = self.event_target(host, event)
+                if target and self.own_event(event):
+                    log.debug("%s event from %s for %s branch %s caused by sf-repo, ignored" % (event['type'], host, target[0], target[1]))
+                elif target:
+                    log.debug("%s event from %s for %s branch %s" % (event['type'], host, target[0], target[1]))
+                    self.pending[target] = time.time()
+            except Queue.Empty:
+                pass
+
+            # a branch is polled once its events have been quiet for the
+            # debounce interval
+            now = time.time()
+            for target, last_event in self.pending.items():
+                if now - last_event >= self.debounce:
+                    del self.pending[target]
+                    self.poll(*target)
+                    self.repos.maintain()
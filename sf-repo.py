@@ -2,9 +2,16 @@ import yaml
 import sys
 import re
 import argparse
+import logging
 import os
-from core.colorlog import log,logsummary
+from core.colorlog import log, logsummary, setup_logging, stop_logging
 from core.repos import Repos
+from core.watcher import Watcher
+from core.server import Server
+from core.repotypes.sshpool import pool
+from core.repotypes.git import Git
+from core import metrics
+from core import trace
 
 
 def projectname(project_name):
@@ -23,12 +30,32 @@ def parse_args(parser):
     parser.add_argument('-m', '--watch-method', dest='watch_method', action='store', help='upstream branch to consider')
     parser.add_argument('-w', '--watch-branches', dest='watch_branches', action='store', help='upstream branch to consider')
     parser.add_argument('--no-fetch', dest='fetch', action='store_false', help='upstream branch to consider')
+    parser.add_argument('--log-dir', dest='log_dir', action='store', help='write one rotated log per project here, only summary lines go to the console')
+    parser.add_argument('--log-level', dest='log_level', action='store', default='DEBUG', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], help='minimum level of the logged messages')
+    parser.add_argument('--shared-objects', dest='shared_objects', action='store_true', help='keep the objects of all the projects in one repository in base dir')
+    parser.add_argument('--metrics-file', dest='metrics_file', action='store', help='write command and poll timings here in prometheus text format')
+    parser.add_argument('--trace', dest='trace_file', action='store', help='write a chrome trace of the polls here, about:tracing or perfetto can load it')
+    parser.add_argument('--trace-profile', dest='trace_profile', action='store_true', help='add the python functions of sf-repo that take more than 1ms to the trace')
+    parser.add_argument('--jobs', '-j', dest='jobs', action='store', type=int, default=1, help='number of projects to poll in parallel')
+    parser.add_argument('--ssh-command', dest='ssh_command', action='store', default='ssh', help='ssh client used to reach gerrit hosts')
+    parser.add_argument('--ssh-control-dir', dest='ssh_control_dir', action='store', help='directory for the ssh control sockets')
+    parser.add_argument('--git-timeout', dest='git_timeout', action='store', type=int, default=600, help='seconds before a git fetch, push or ls-remote is killed')
+    parser.add_argument('--ssh-max-sessions', dest='ssh_max_sessions', action='store', type=int, default=4, help='concurrent ssh commands per gerrit host')
 
     subparsers = parser.add_subparsers(dest='command')
 
     parser_new_original_change = subparsers.add_parser('poll')
     parser_new_original_change.add_argument('-b', '--original-branch', dest='original_branch', action='store',  help='upstream branch to consider')
 
+    parser_watch = subparsers.add_parser('watch')
+    parser_watch.add_argument('--debounce', dest='debounce', action='store', type=int, default=10, help='seconds without events before a branch is polled')
+    parser_watch.add_argument('--account', dest='accounts', action='append', default=['sf-repo'], help='gerrit username or email sf-repo uses, the events it causes are ignored. Can be repeated')
+
+    parser_serve = subparsers.add_parser('serve')
+    parser_serve.add_argument('--interval', dest='interval', action='store', type=int, default=300, help='seconds between polls of a project, unless it sets poll-interval')
+    parser_serve.add_argument('--jitter', dest='jitter', action='store', type=int, default=60, help='maximum random seconds added to the interval, unless the project sets poll-jitter')
+    parser_serve.add_argument('--socket', dest='socket_path', action='store', help='control socket path, base-dir/sf-repo.sock by default')
+
     args = parser.parse_args()
 
     return args
@@ -38,11 +65,22 @@ if __name__=="__main__":
 
     parser = argparse.ArgumentParser(description='Map the git out of upstream')
     args = parse_args(parser)
+    setup_logging(log_dir=args.log_dir, level=getattr(logging, args.log_level))
     log.debugvar('args')
 
+    pool.configure(control_dir=args.ssh_control_dir, max_sessions=args.ssh_max_sessions, ssh_command=args.ssh_command)
+    os.environ['GIT_SSH_COMMAND'] = pool.git_ssh_command()
+    Git.network_timeout = args.git_timeout
+    metrics.configure(args.metrics_file)
+    if args.trace_file:
+        trace.enable(args.trace_file, profile=args.trace_profile)
+
+    if args.command == 'watch' and not args.watch_method:
+        args.watch_method = 'events'
+
     projects = yaml.load(args.projects_path.read())
     try:
-        repos = Repos(projects, args.base_dir, filter_projects=args.projects, filter_method=args.watch_method, filter_branches=args.watch_branches, fetch=args.fetch)
+        repos = Repos(projects, args.base_dir, filter_projects=args.projects, filter_method=args.watch_method, filter_branches=args.watch_branches, fetch=args.fetch, shared_objects=args.shared_objects)
     except ValueError:
         log.critical('No projects to handle')
         sys.exit(1)
@@ -50,5 +88,12 @@ if __name__=="__main__":
     ## actions
 
     if args.command == 'poll':
-        repos.poll(fetch=args.fetch)
+        repos.poll(fetch=args.fetch, jobs=args.jobs)
+        trace.write()
+    elif args.command == 'watch':
+        Watcher(repos, fetch=args.fetch, debounce=args.debounce, accounts=args.accounts).run()
+    elif args.command == 'serve':
+        Server(repos, fetch=args.fetch, interval=args.interval, jitter=args.jitter, socket_path=args.socket_path).run()
+
+    stop_logging()
 